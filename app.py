@@ -1,15 +1,24 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, send_from_directory
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_cors import CORS
 from models import db, User, Watchlist, Notification, Portfolio
 from technical_analysis import analyze_symbol
 import os
+import csv
+import io
+import json
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from threading import Lock
+from datetime import datetime
 
 load_dotenv()
-from crypto import init_db, run_pipeline, ensure_ohlcv_data, fetch_mappings, fetch_mapping, fetch_scalar
+from crypto import (
+    check_schema, ensure_ohlcv_data, fetch_mappings, fetch_mapping, fetch_scalar, list_pipeline_runs, get_pipeline_run,
+    last_closed_candle_ms, ohlcv_cutoff_day, ohlcv_day, read_your_writes, stream_rows, schedule_background_backfill, CANDLE_COLUMNS, TOP_COINS_COLUMNS
+)
+from demand import record_symbol_request, start_demand_tracking
+from price_stream import get_coin, get_live_price, start_price_stream
+from snapshots import OHLCV_SNAPSHOT_DIR, SNAPSHOT_MIMETYPES, load_snapshot_manifest
+from scheduler import SCHEDULER_MODE, enqueue_pipeline_run, get_job, list_jobs, start_scheduler
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key')
@@ -38,16 +47,32 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in or sign up to access this page.'
 login_manager.login_message_category = 'info'
 
-pipeline_lock = Lock()
-
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
-# Initialize databases
+# Initialize databases. Market-data migrations run as a separate deploy
+# step (`python crypto.py migrate`); workers only refuse to start on an
+# outdated schema.
 with app.app_context():
     db.create_all()
-    init_db()
+    check_schema()
+
+# Background services belong to the web process only. Under `python app.py`
+# the spawned pipeline child re-imports this module as __mp_main__ (before
+# multiprocessing.parent_process() is set), and must not start a second
+# scheduler, demand flusher or price stream.
+if __name__ != '__mp_main__':
+    # Scheduled and manual pipeline runs execute in a child process, off the web workers
+    if SCHEDULER_MODE == "embedded":
+        start_scheduler()
+
+    # Watchlist/portfolio/alert membership and API hits decide which pairs
+    # the pipeline refreshes first
+    start_demand_tracking(app)
+
+    # Live prices for watchlist, portfolio and alert checks come from memory
+    start_price_stream()
 
 # ==================== AUTHENTICATION ROUTES ====================
 
@@ -141,11 +166,11 @@ def get_coins():
     limit = int(request.args.get('limit', 100))
     offset = int(request.args.get('offset', 0))
 
-    query = "SELECT * FROM top_coins WHERE 1=1"
+    query = f"SELECT {', '.join(TOP_COINS_COLUMNS)} FROM top_coins WHERE 1=1"
     params = {}
 
     if search:
-        query += " AND (UPPER(symbol) LIKE :search OR UPPER(name) LIKE :search)"
+        query += " AND (symbol_key LIKE :search OR UPPER(name) LIKE :search)"
         params["search"] = f'%{search}%'
 
     valid_sorts = ['market_cap_rank', 'price', 'market_cap', 'volume_24h', 'liquidity_score']
@@ -169,8 +194,9 @@ def get_coins():
 
 @app.route('/api/coin/<symbol>')
 def get_coin_details(symbol):
+    record_symbol_request(symbol)
     coin = fetch_mapping(
-        "SELECT * FROM top_coins WHERE UPPER(symbol) = :symbol",
+        f"SELECT {', '.join(TOP_COINS_COLUMNS)} FROM top_coins WHERE symbol_key = :symbol",
         {"symbol": symbol.upper()}
     )
 
@@ -183,6 +209,7 @@ def get_coin_details(symbol):
 def get_ohlcv_data(symbol):
     period = request.args.get('period', '1m')  # 1m, 3m, 6m, 1y, 10y
     pair = symbol.upper() + 'USDT'
+    record_symbol_request(symbol)
 
     period_map = {
         '1m': 30,
@@ -193,27 +220,107 @@ def get_ohlcv_data(symbol):
     }
 
     days = period_map.get(period, 30)
-    cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    cutoff_day = ohlcv_cutoff_day(days)
 
     rows = fetch_mappings("""
         SELECT date, open, high, low, close, volume
         FROM ohlcv_data
-        WHERE symbol = :symbol AND date >= :cutoff_date
-        ORDER BY date ASC
-    """, {"symbol": pair, "cutoff_date": cutoff_date})
+        WHERE symbol = :symbol AND day >= :cutoff_day
+        ORDER BY day ASC
+    """, {"symbol": pair, "cutoff_day": cutoff_day})
     data = rows
 
     if not data:
         ensure_ohlcv_data(symbol, max_days=days)
-        data = fetch_mappings("""
-            SELECT date, open, high, low, close, volume
-            FROM ohlcv_data
-            WHERE symbol = :symbol AND date >= :cutoff_date
-            ORDER BY date ASC
-        """, {"symbol": pair, "cutoff_date": cutoff_date})
+        with read_your_writes():
+            data = fetch_mappings("""
+                SELECT date, open, high, low, close, volume
+                FROM ohlcv_data
+                WHERE symbol = :symbol AND day >= :cutoff_day
+                ORDER BY day ASC
+            """, {"symbol": pair, "cutoff_day": cutoff_day})
+    else:
+        # Long-tail pairs are only refreshed lazily; top up in the background when read
+        last_closed = datetime.utcfromtimestamp(last_closed_candle_ms() / 1000).strftime('%Y-%m-%d')
+        if data[-1]['date'] < last_closed:
+            schedule_background_backfill(symbol)
 
     return jsonify(data)
 
+# ==================== BULK DATA API ====================
+
+@app.route('/api/snapshots/ohlcv')
+def ohlcv_snapshots():
+    """Manifest of the columnar OHLCV snapshots written after each pipeline run"""
+    manifest = load_snapshot_manifest()
+    if not manifest:
+        return jsonify({'error': 'No OHLCV snapshots yet'}), 404
+    for entry in [manifest['combined']] + list(manifest['pairs'].values()):
+        entry['url'] = url_for('ohlcv_snapshot_file', filename=entry['file'])
+    return jsonify(manifest)
+
+@app.route('/api/snapshots/ohlcv/<path:filename>')
+def ohlcv_snapshot_file(filename):
+    """One snapshot file; supports Range, ETag and If-Modified-Since requests"""
+    mimetype = SNAPSHOT_MIMETYPES.get(os.path.splitext(filename)[1])
+    if not mimetype:
+        return jsonify({'error': 'Snapshot not found'}), 404
+    return send_from_directory(OHLCV_SNAPSHOT_DIR, filename, mimetype=mimetype, conditional=True)
+
+# Symbols per /api/export/ohlcv request.
+OHLCV_EXPORT_MAX_SYMBOLS = int(os.getenv('OHLCV_EXPORT_MAX_SYMBOLS', '1000'))
+
+def _ndjson_chunks(batches):
+    for columns, rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+def _csv_chunks(columns, batches):
+    # Header first, from the selected columns, so an export with no rows
+    # still reads as an empty table rather than an empty body.
+    yield ','.join(columns) + '\n'
+    for _, rows in batches:
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator='\n').writerows(rows)
+        yield buf.getvalue()
+
+@app.route('/api/export/ohlcv')
+def export_ohlcv():
+    """Stream candles for several symbols and a date range as NDJSON or CSV"""
+    symbols = [s.strip().upper() for s in request.args.get('symbols', '').split(',') if s.strip()]
+    fmt = request.args.get('format', 'ndjson').lower()
+    if not symbols:
+        return jsonify({'error': 'symbols is required, e.g. symbols=BTC,ETH'}), 400
+    if len(symbols) > OHLCV_EXPORT_MAX_SYMBOLS:
+        return jsonify({'error': f'At most {OHLCV_EXPORT_MAX_SYMBOLS} symbols per export'}), 400
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    try:
+        start_day = ohlcv_day(request.args['start']) if request.args.get('start') else 0
+        end_day = ohlcv_day(request.args['end']) if request.args.get('end') else ohlcv_cutoff_day(0)
+    except ValueError:
+        return jsonify({'error': 'start and end must be YYYY-MM-DD dates'}), 400
+
+    names = [f's{i}' for i in range(len(symbols))]
+    params = dict(zip(names, [s + 'USDT' for s in symbols]))
+    params.update(start_day=start_day, end_day=end_day)
+    # Ordered along idx_ohlcv_symbol_day, so rows leave the index as they are sent.
+    batches = stream_rows(f"""
+        SELECT {', '.join(CANDLE_COLUMNS)}
+        FROM ohlcv_data
+        WHERE symbol IN ({', '.join(':' + n for n in names)})
+          AND day BETWEEN :start_day AND :end_day
+        ORDER BY symbol, day
+    """, params)
+
+    if fmt == 'csv':
+        body, mimetype = _csv_chunks(CANDLE_COLUMNS, batches), 'text/csv'
+    else:
+        body, mimetype = _ndjson_chunks(batches), 'application/x-ndjson'
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=ohlcv.{fmt}',
+        'X-Accel-Buffering': 'no'
+    })
+
 # ==================== WATCHLIST API ====================
 
 @app.route('/api/watchlist', methods=['GET'])
@@ -223,10 +330,7 @@ def get_watchlist():
 
     items = []
     for item in watchlist_items:
-        coin = fetch_mapping(
-            "SELECT * FROM top_coins WHERE UPPER(symbol) = :symbol",
-            {"symbol": item.symbol.upper()}
-        )
+        coin = get_coin(item.symbol)
 
         if coin:
             items.append({
@@ -341,10 +445,7 @@ def check_notifications():
 
     triggered = []
     for notif in notifications:
-        price = fetch_scalar(
-            "SELECT price FROM top_coins WHERE UPPER(symbol) = :symbol",
-            {"symbol": notif.symbol.upper()}
-        )
+        price = get_live_price(notif.symbol)
 
         if price is not None and notif.check_trigger(price):
             triggered.append({
@@ -371,10 +472,7 @@ def get_portfolio():
     total_current_value = 0
 
     for item in portfolio_items:
-        coin = fetch_mapping(
-            "SELECT * FROM top_coins WHERE UPPER(symbol) = :symbol",
-            {"symbol": item.symbol.upper()}
-        )
+        coin = get_coin(item.symbol)
 
         if coin:
             current_price = coin['price']
@@ -458,6 +556,7 @@ def technical_analysis_page():
 def get_technical_analysis(symbol):
     """Get technical analysis for a coin"""
     try:
+        record_symbol_request(symbol)
         ensure_ohlcv_data(symbol)
         result = analyze_symbol(symbol)
         return jsonify(result)
@@ -474,6 +573,7 @@ def price_prediction_page():
 def predict_crypto_price(symbol):
     """Predict future prices using LSTM"""
     try:
+        record_symbol_request(symbol)
         from lstm_prediction import predict_price
 
         days_ahead = int(request.args.get('days', 7))
@@ -506,24 +606,52 @@ def train_lstm_model(symbol):
 @app.route('/api/update-data', methods=['POST'])
 @login_required
 def update_data():
-    """Trigger data pipeline update"""
-    if not pipeline_lock.acquire(blocking=False):
-        return jsonify({'success': False, 'error': 'Update already in progress'}), 429
-
+    """Queue a data pipeline run; poll /api/update-data/<job_id> for its status"""
     try:
-        stats = run_pipeline()
-        if stats.get("top_coins", 0) == 0:
-            return jsonify({
-                'success': False,
-                'error': 'Top coins table is still empty after update. Check Coingecko API access and DATABASE_URL.',
-                'stats': stats
-            }), 500
-        return jsonify({'success': True, 'message': 'Data updated successfully', 'stats': stats})
+        job, created = enqueue_pipeline_run("manual")
     except Exception as e:
-        app.logger.exception("Pipeline update failed")
+        app.logger.exception("Could not enqueue pipeline run")
         return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        pipeline_lock.release()
+
+    return jsonify({
+        'success': True,
+        'message': 'Update queued' if created else 'Update already in progress',
+        'job_id': job['id'],
+        'status': job['status']
+    }), 202
+
+@app.route('/api/update-data/<job_id>')
+@login_required
+def update_data_status(job_id):
+    """Status of a queued, running or finished pipeline run"""
+    job = get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/update-data/jobs')
+@login_required
+def update_data_jobs():
+    limit = min(int(request.args.get('limit', 20)), 100)
+    return jsonify(list_jobs(limit))
+
+@app.route('/api/pipeline-runs')
+@login_required
+def pipeline_runs():
+    """Recent pipeline runs with stage timings, HTTP counters and throughput"""
+    limit = min(int(request.args.get('limit', 20)), 200)
+    return jsonify(list_pipeline_runs(limit))
+
+@app.route('/api/pipeline-runs/<run_id>')
+@login_required
+def pipeline_run_details(run_id):
+    """One pipeline run plus its per-pair results (order: slowest, candles, failed)"""
+    pair_limit = min(int(request.args.get('pairs', 50)), 5000)
+    order = request.args.get('order', 'slowest')
+    run = get_pipeline_run(run_id, pair_limit, order)
+    if not run:
+        return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import crypto
+from http_client import get_http_client
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+BINANCE_ASYNC_CONCURRENCY = int(os.getenv("BINANCE_ASYNC_CONCURRENCY", "200"))
+BINANCE_MAX_RETRIES = int(os.getenv("BINANCE_MAX_RETRIES", "4"))
+INGEST_WRITE_BATCH_ROWS = int(os.getenv("INGEST_WRITE_BATCH_ROWS", "5000"))
+
+KLINES_LIMIT = crypto.KLINES_LIMIT
+KLINES_WEIGHT = crypto.KLINES_WEIGHT
+DAY_MS = crypto.DAY_MS
+
+
+class WeightGovernor:
+    """Keeps request weight under Binance's per-minute budget (X-MBX-USED-WEIGHT-1M)"""
+
+    def __init__(self, limit, headroom=crypto.BINANCE_WEIGHT_HEADROOM):
+        self.budget = max(int(limit * headroom), KLINES_WEIGHT)
+        self.window = int(time.time() // 60)
+        self.used = 0
+        self.blocked_until = 0.0
+
+    def _roll(self, now):
+        window = int(now // 60)
+        if window != self.window:
+            self.window = window
+            self.used = 0
+
+    async def acquire(self, weight=KLINES_WEIGHT):
+        while True:
+            now = time.time()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._roll(now)
+            if self.used + weight <= self.budget:
+                self.used += weight
+                return
+            # Budget spent for this minute; wait for Binance's window to reset.
+            await asyncio.sleep(60 - (now % 60) + 0.05)
+
+    def observe(self, headers):
+        used = headers.get("X-MBX-USED-WEIGHT-1M") or headers.get("X-MBX-USED-WEIGHT")
+        if not used:
+            return
+        try:
+            used = int(used)
+        except ValueError:
+            return
+        self._roll(time.time())
+        self.used = max(self.used, used)
+
+    def backoff(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+
+async def _get_klines(session, sem, governor, base, pair, start_ms, end_ms, limit=KLINES_LIMIT):
+    params = {
+        "symbol": pair,
+        "interval": "1d",
+        "startTime": start_ms,
+        "endTime": end_ms,
+        "limit": limit
+    }
+
+    # Same per-host bucket and request counters the synchronous fetchers use.
+    client = get_http_client()
+    bucket = client.bucket_for(base)
+
+    for attempt in range(BINANCE_MAX_RETRIES):
+        await governor.acquire(KLINES_WEIGHT)
+        wait = bucket.reserve(KLINES_WEIGHT)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        retries = 1 if attempt else 0
+        try:
+            async with sem:
+                async with session.get(base + "/api/v3/klines", params=params) as r:
+                    governor.observe(r.headers)
+                    raw = await r.read()
+                    client.record(
+                        requests=1,
+                        retries=retries,
+                        throttled=1 if r.status in (418, 429) else 0,
+                        errors=1 if r.status >= 400 else 0,
+                        nbytes=len(raw)
+                    )
+                    if r.status == 200:
+                        return json.loads(raw)
+                    body = raw[:200].decode("utf-8", "replace")
+                    if r.status in (418, 429):
+                        retry_after = r.headers.get("Retry-After")
+                        wait = float(retry_after) if retry_after else 2.0 * (2 ** attempt)
+                        print(f"Binance rate limit hit ({base}, {r.status}); pausing {wait:.1f}s")
+                        governor.backoff(wait)
+                        bucket.pause(wait)
+                        continue
+                    if r.status >= 500:
+                        await asyncio.sleep(1.0 * (2 ** attempt))
+                        continue
+                    print(f"Binance klines error ({base}): status={r.status} body={body}")
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            client.record(requests=1, retries=retries, errors=1)
+            print(f"Binance klines request failed for {pair}: {e}")
+            await asyncio.sleep(1.0 * (2 ** attempt))
+
+    return None
+
+
+async def _ingest_range(session, sem, governor, queue, base, pair, cursor, end_ms):
+    """Walk kline pages from cursor to end_ms; returns an error string or None"""
+    while cursor <= end_ms:
+        chunk = await _get_klines(session, sem, governor, base, pair, cursor, end_ms)
+        if chunk is None:
+            # Binance request failed for this pair; continue pipeline.
+            return "Binance klines request failed"
+        if not isinstance(chunk, list) or len(chunk) == 0:
+            return None
+
+        await queue.put(("page", pair, crypto._parse_kline_page(pair, chunk)))
+
+        cursor = int(chunk[-1][0]) + 1
+        if len(chunk) < KLINES_LIMIT:
+            return None
+    return None
+
+
+async def _ingest_pair(session, sem, governors, queue, coin, end_ms):
+    pair = coin["binance_pair"]
+    base = (coin.get("binance_base") or crypto._ACTIVE_BINANCE_BASE).rstrip("/")
+    governor = governors.get(base)
+    if governor is None:
+        governor = governors[base] = WeightGovernor(crypto.binance_weight_limit(base))
+    last_ts = coin.get("last_timestamp")
+    cursor = int(last_ts) + DAY_MS if last_ts else 0
+    # Expired history is not fetched back in.
+    floor = crypto.ohlcv_retention_cutoff_ms(end_ms)
+
+    if cursor > 0 or not crypto.BINANCE_SHARDED_BACKFILL:
+        return await _ingest_range(session, sem, governor, queue, base, pair, max(cursor, floor), end_ms)
+
+    # Cold pair: find the listing candle, then fetch every page-sized window at once.
+    probe = await _get_klines(session, sem, governor, base, pair, floor, end_ms, limit=1)
+    if probe is None:
+        return "Binance klines probe failed"
+    if not probe:
+        return None
+    windows = crypto._shard_windows(int(probe[0][0]), end_ms)
+    errors = await asyncio.gather(*[
+        _ingest_range(session, sem, governor, queue, base, pair, w_start, w_end)
+        for w_start, w_end in windows
+    ])
+    return next((e for e in errors if e), None)
+
+
+async def _ingest_pair_timed(session, sem, governors, queue, coin, end_ms):
+    """Run _ingest_pair and queue a done marker behind the pair's pages"""
+    started = time.perf_counter()
+    try:
+        outcome = await _ingest_pair(session, sem, governors, queue, coin, end_ms)
+    except Exception as e:
+        outcome = e
+    seconds = time.perf_counter() - started
+    await queue.put(("done", coin["binance_pair"], (outcome, seconds)))
+    return outcome, seconds
+
+
+def _pair_result(pair, counts, write_errors, outcome, seconds):
+    # A fetch that succeeded still failed if its candles never committed.
+    error = outcome or write_errors.get(pair)
+    return {
+        "symbol": pair,
+        "candles": counts.get(pair, 0),
+        "seconds": seconds,
+        "error": str(error) if error else None
+    }
+
+
+async def _writer(queue, counts, write_errors, on_pairs_done=None):
+    """Drain parsed pages into _save_candles, coalescing pages that arrive together"""
+    # A pair's done marker is queued after its pages, so by the time
+    # on_pairs_done sees it every batch holding its candles has either
+    # committed (and is in counts) or failed (and is in write_errors).
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as db_executor:
+        done = False
+        while not done:
+            item = await queue.get()
+            batch = []
+            batch_counts = {}
+            finished = []
+            while True:
+                if item is None:
+                    done = True
+                    break
+                kind, pair, payload = item
+                if kind == "page":
+                    batch.extend(payload)
+                    batch_counts[pair] = batch_counts.get(pair, 0) + len(payload)
+                else:
+                    finished.append((pair, payload))
+                if len(batch) >= INGEST_WRITE_BATCH_ROWS or queue.empty():
+                    break
+                item = queue.get_nowait()
+
+            if batch:
+                try:
+                    await loop.run_in_executor(db_executor, crypto._save_candles, batch)
+                except Exception as e:
+                    print(f"OHLCV write failed ({len(batch)} candles): {e}")
+                    for pair in batch_counts:
+                        write_errors.setdefault(pair, f"OHLCV write failed: {e}")
+                else:
+                    for pair, n in batch_counts.items():
+                        counts[pair] = counts.get(pair, 0) + n
+            if finished and on_pairs_done:
+                results = [_pair_result(pair, counts, write_errors, *outcome) for pair, outcome in finished]
+                try:
+                    await loop.run_in_executor(db_executor, on_pairs_done, results)
+                except Exception as e:
+                    print(f"Could not checkpoint {len(results)} pairs: {e}")
+
+
+async def _ingest_all(coins, concurrency, on_pairs_done=None):
+    sem = asyncio.Semaphore(concurrency)
+    governors = {}
+    queue = asyncio.Queue(maxsize=max(concurrency, 1) * 2)
+    counts = {}
+    write_errors = {}
+    end_ms = int(time.time() * 1000)
+
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30)
+    writer = asyncio.create_task(_writer(queue, counts, write_errors, on_pairs_done))
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = [
+            _ingest_pair_timed(session, sem, governors, queue, coin, end_ms)
+            for coin in coins
+        ]
+        outcomes = await asyncio.gather(*tasks)
+
+    await queue.put(None)
+    await writer
+
+    checks = []
+    complete = []
+    for coin, (outcome, _) in zip(coins, outcomes):
+        pair = coin["binance_pair"]
+        if isinstance(outcome, Exception):
+            print(f"OHLCV fetch failed for {pair}: {outcome}")
+        error = outcome or write_errors.get(pair)
+        checks.append((pair, error))
+        if not error and not coin.get("last_timestamp"):
+            complete.append(pair)
+
+    try:
+        crypto.record_ingestion_checks(checks)
+        # Cold pairs fetched from start_ms=0 now hold their full history.
+        crypto.mark_history_complete([p for p in complete if counts.get(p)])
+    except Exception as e:
+        print(f"Could not record ingestion checks: {e}")
+
+    return [
+        _pair_result(coin["binance_pair"], counts, write_errors, outcome, seconds)
+        for coin, (outcome, seconds) in zip(coins, outcomes)
+    ]
+
+
+def ingest_pairs(coins, concurrency=None, on_pairs_done=None):
+    """Fetch missing daily candles for every coin concurrently; returns one result dict per pair"""
+    if not coins:
+        return []
+    concurrency = max(concurrency or BINANCE_ASYNC_CONCURRENCY, 1)
+    return asyncio.run(_ingest_all(coins, concurrency, on_pairs_done))
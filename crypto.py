@@ -1,12 +1,20 @@
-import requests
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
 import datetime as dt
 import time
 import os
-from sqlalchemy import create_engine, text
-from sqlalchemy.pool import NullPool
+import socket
+import sqlite3
+import sys
+import threading
+import uuid
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.pool import NullPool, QueuePool
 from urllib.parse import urlparse
 from dotenv import load_dotenv
+import numpy as np
+from http_client import get_http_client, http_get
 
 load_dotenv()
 
@@ -14,6 +22,8 @@ DATA_DIR = os.getenv('DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.getenv('COINGECKO_DB_PATH', os.path.join(DATA_DIR, 'coingecko_top1000.db'))
 DATABASE_URL = os.getenv('DATABASE_URL') or os.getenv('SUPABASE_DATABASE_URL')
+# Optional read replica for fetch_mappings/fetch_mapping/fetch_scalar.
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL') or os.getenv('SUPABASE_READ_DATABASE_URL')
 COINGECKO_BASE = os.getenv("COINGECKO_API_BASE", "https://api.coingecko.com").rstrip("/")
 API_KEY = os.getenv("COINGECKO_API_KEY") or ""
 API_KEY_TYPE = os.getenv("COINGECKO_API_KEY_TYPE", "").strip().lower()
@@ -32,10 +42,133 @@ BINANCE_BASES = [
 BINANCE_MAX_COINS = int(os.getenv("BINANCE_MAX_COINS", "0"))
 BINANCE_MAX_YEARS = int(os.getenv("BINANCE_MAX_YEARS", "5"))
 BINANCE_WORKERS = int(os.getenv("BINANCE_WORKERS", "4"))
+# "async" uses the aiohttp engine in async_ingest.py; "threads" keeps the
+# ThreadPoolExecutor(BINANCE_WORKERS) path.
+BINANCE_INGEST_MODE = os.getenv("BINANCE_INGEST_MODE", "async").strip().lower()
+# Cold backfills (start_ms=0) probe the listing date and fetch page-sized
+# windows in parallel instead of walking page after page.
+BINANCE_SHARDED_BACKFILL = os.getenv("BINANCE_SHARDED_BACKFILL", "1") != "0"
+BINANCE_BACKFILL_WORKERS = int(os.getenv("BINANCE_BACKFILL_WORKERS", "8"))
+
+DAY_MS = 86400000
+KLINES_LIMIT = 1000
+KLINES_WEIGHT = 2
+EXCHANGE_INFO_WEIGHT = 20
+TICKER_24HR_WEIGHT = 80  # all symbols in one call
+
+# Per-upstream token buckets for http_client. Coingecko is limited in calls,
+# Binance in request weight (klines=2, exchangeInfo=20) per minute.
+_COINGECKO_DEFAULT_RATE = {"pro": "8", "demo": "0.5"}.get(API_KEY_TYPE, "0.5") if API_KEY else "0.2"
+COINGECKO_RATE_PER_SEC = float(os.getenv("COINGECKO_RATE_PER_SEC", _COINGECKO_DEFAULT_RATE))
+COINGECKO_BURST = float(os.getenv("COINGECKO_BURST", "10" if API_KEY_TYPE == "pro" and API_KEY else "3"))
+# Market pages fetched in parallel; the Coingecko bucket adapts its rate to
+# observed 429s, so this only caps how many requests can be in flight.
+_COINGECKO_DEFAULT_CONCURRENCY = {"pro": "8", "demo": "2"}.get(API_KEY_TYPE, "2") if API_KEY else "1"
+COINGECKO_CONCURRENCY = int(os.getenv("COINGECKO_CONCURRENCY", _COINGECKO_DEFAULT_CONCURRENCY))
+BINANCE_WEIGHT_LIMIT_1M = int(os.getenv("BINANCE_WEIGHT_LIMIT_1M", "6000"))
+BINANCE_US_WEIGHT_LIMIT_1M = int(os.getenv("BINANCE_US_WEIGHT_LIMIT_1M", "1200"))
+BINANCE_WEIGHT_HEADROOM = float(os.getenv("BINANCE_WEIGHT_HEADROOM", "0.9"))
+# exchangeInfo is several MB; the TRADING USDT set is cached in-process and in
+# the binance_symbols table. Past the TTL the stale set is still served while
+# a background thread refreshes it.
+BINANCE_SYMBOLS_TTL_SEC = int(os.getenv("BINANCE_SYMBOLS_TTL_SEC", "21600"))
+# ensure_ohlcv_data skips Binance when a pair's history is complete and its
+# newest candle is at most this far behind the last closed daily candle.
+OHLCV_STALENESS_TOLERANCE_SEC = int(os.getenv("OHLCV_STALENESS_TOLERANCE_SEC", "0"))
+# On-demand backfills bounded by max_days fetch only that window inline and
+# leave the deeper history to these background workers.
+OHLCV_BACKGROUND_WORKERS = int(os.getenv("OHLCV_BACKGROUND_WORKERS", "2"))
+# Lease locks in db_locks keep pipeline runs and per-pair on-demand backfills
+# single-flight across workers and instances. A holder renews its lease every
+# ttl/3 seconds; a crashed holder's lease lapses after the TTL.
+PIPELINE_LOCK_TTL_SEC = int(os.getenv("PIPELINE_LOCK_TTL_SEC", "120"))
+OHLCV_LOCK_TTL_SEC = int(os.getenv("OHLCV_LOCK_TTL_SEC", "120"))
+# How long an on-demand request waits for another process fetching the same pair.
+OHLCV_LOCK_WAIT_SEC = float(os.getenv("OHLCV_LOCK_WAIT_SEC", "30"))
+# Refetch holes between stored daily candles at the end of each pipeline run.
+OHLCV_GAP_REPAIR = os.getenv("OHLCV_GAP_REPAIR", "1") != "0"
+OHLCV_GAP_REPAIR_MAX = int(os.getenv("OHLCV_GAP_REPAIR_MAX", "500"))
+# Demand-driven ingestion: pairs are scored by how many users watch, hold or
+# have alerts on them plus recent API requests (decayed by age in days).
+DEMAND_WATCHLIST_WEIGHT = float(os.getenv("DEMAND_WATCHLIST_WEIGHT", "5"))
+DEMAND_PORTFOLIO_WEIGHT = float(os.getenv("DEMAND_PORTFOLIO_WEIGHT", "8"))
+DEMAND_NOTIFICATION_WEIGHT = float(os.getenv("DEMAND_NOTIFICATION_WEIGHT", "3"))
+DEMAND_WINDOW_DAYS = int(os.getenv("DEMAND_WINDOW_DAYS", "7"))
+# Pairs nobody asks for are refreshed at most this often by the pipeline
+# (0 refreshes every pair every run); reading them refreshes them on demand.
+OHLCV_TAIL_REFRESH_SEC = int(os.getenv("OHLCV_TAIL_REFRESH_SEC", "259200"))
+# Hot pairs (score >= OHLCV_HOT_MIN_SCORE) are also refreshed between runs.
+OHLCV_HOT_MIN_SCORE = float(os.getenv("OHLCV_HOT_MIN_SCORE", "1"))
+OHLCV_HOT_MAX_PAIRS = int(os.getenv("OHLCV_HOT_MAX_PAIRS", "100"))
+# Intraday top_coins price/volume refresh from Binance's bulk 24hr ticker.
+PRICE_REFRESH_SEC = float(os.getenv("PRICE_REFRESH_SEC", "60"))
+# An interrupted run younger than this resumes with only its unfinished pairs.
+PIPELINE_RESUME_MAX_AGE_SEC = int(os.getenv("PIPELINE_RESUME_MAX_AGE_SEC", "43200"))
+# Bulk candle writes: COPY into a staging table on Postgres, multi-row
+# VALUES batches of up to OHLCV_INSERT_BATCH_ROWS rows on SQLite.
+OHLCV_COPY_WRITES = os.getenv("OHLCV_COPY_WRITES", "1") != "0"
+OHLCV_INSERT_BATCH_ROWS = int(os.getenv("OHLCV_INSERT_BATCH_ROWS", "500"))
+# Postgres layout of ohlcv_data: "" leaves the table as it is, "year"
+# range-partitions it by candle year, "symbol" hash-partitions it by pair into
+# OHLCV_HASH_PARTITIONS. Converting an existing table is a one-time offline
+# operation (`python crypto.py partition` with the app and scheduler
+# stopped); the daily storage maintenance then keeps the next year's
+# partition created ahead of time.
+OHLCV_PARTITIONING = os.getenv("OHLCV_PARTITIONING", "").strip().lower()
+OHLCV_HASH_PARTITIONS = int(os.getenv("OHLCV_HASH_PARTITIONS", "16"))
+# Candles from before Jan 1 of (current year - OHLCV_RETENTION_YEARS) are
+# expired by the daily storage maintenance and never fetched again (0 keeps
+# all history). "archive" moves them out (expired year partitions are
+# detached as ohlcv_archive_y<year>, other rows go to ohlcv_archive); "drop"
+# deletes them.
+OHLCV_RETENTION_YEARS = int(os.getenv("OHLCV_RETENTION_YEARS", "0"))
+OHLCV_RETENTION_MODE = os.getenv("OHLCV_RETENTION_MODE", "archive").strip().lower()
+
+# SQLite tuning (used only when DATABASE_URL is unset). WAL lets the Flask
+# readers keep going while the pipeline writes; SQLITE_POOL_SIZE=0 falls back
+# to one connection per query (NullPool).
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_MAX_OVERFLOW = int(os.getenv("SQLITE_MAX_OVERFLOW", "16"))
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").strip().upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negative = KiB
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Postgres reads go through their own engine: the replica when
+# DATABASE_READ_URL is set, otherwise a second pool on the primary, so
+# pipeline writes cannot take the connections user-facing reads need.
+# Statement timeout is sent as a startup option; set it to 0 for poolers
+# that reject the `options` parameter.
+READ_DB_POOL_SIZE = int(os.getenv("READ_DB_POOL_SIZE", "5"))
+READ_DB_MAX_OVERFLOW = int(os.getenv("READ_DB_MAX_OVERFLOW", "10"))
+READ_DB_STATEMENT_TIMEOUT_MS = int(os.getenv("READ_DB_STATEMENT_TIMEOUT_MS", "15000"))
+# Rows fetched per round trip by stream_rows (server-side cursor on Postgres).
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "5000"))
 
 _DB_ENGINE = None
+_DB_READ_ENGINE = None
 _DB_IS_POSTGRES = None
+_READ_YOUR_WRITES = contextvars.ContextVar("read_your_writes", default=False)
 _ACTIVE_BINANCE_BASE = BINANCE_BASES[0] if BINANCE_BASES else BINANCE_BASE
+_BINANCE_SYMBOLS_CACHE = {"symbols": None, "base": None, "fetched_at": 0.0}
+_BINANCE_SYMBOLS_LOCK = threading.Lock()
+_BINANCE_SYMBOLS_REFRESHING = threading.Event()
+_BACKGROUND_BACKFILL_EXECUTOR = None
+_BACKGROUND_BACKFILL_PENDING = set()
+_BACKGROUND_BACKFILL_LOCK = threading.Lock()
+
+def binance_weight_limit(base):
+    return BINANCE_US_WEIGHT_LIMIT_1M if "binance.us" in base else BINANCE_WEIGHT_LIMIT_1M
+
+def _configure_http_limits():
+    client = get_http_client()
+    client.configure_host(COINGECKO_BASE, COINGECKO_RATE_PER_SEC, COINGECKO_BURST, adaptive=True)
+    for base in BINANCE_BASES or [BINANCE_BASE]:
+        per_sec = binance_weight_limit(base) * BINANCE_WEIGHT_HEADROOM / 60.0
+        client.configure_host(base, per_sec, max(per_sec * 3, EXCHANGE_INFO_WEIGHT))
+
+_configure_http_limits()
 
 def _normalize_database_url(url):
     if url.startswith("postgres://"):
@@ -44,6 +177,38 @@ def _normalize_database_url(url):
         return "postgresql+psycopg://" + url[len("postgresql://"):]
     return url
 
+def _apply_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    finally:
+        cursor.close()
+
+def _create_sqlite_engine():
+    sqlite_url = f"sqlite:///{DB_PATH}"
+    connect_args = {
+        "check_same_thread": False,
+        "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000.0
+    }
+    if SQLITE_POOL_SIZE > 0:
+        engine = create_engine(
+            sqlite_url,
+            connect_args=connect_args,
+            poolclass=QueuePool,
+            pool_size=SQLITE_POOL_SIZE,
+            max_overflow=SQLITE_MAX_OVERFLOW,
+            pool_timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0
+        )
+    else:
+        engine = create_engine(sqlite_url, connect_args=connect_args, poolclass=NullPool)
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
+    return engine
+
 def get_db_engine():
     global _DB_ENGINE, _DB_IS_POSTGRES
     if _DB_ENGINE is None:
@@ -52,12 +217,7 @@ def get_db_engine():
             _DB_ENGINE = create_engine(db_url, pool_pre_ping=True)
             _DB_IS_POSTGRES = True
         else:
-            sqlite_url = f"sqlite:///{DB_PATH}"
-            _DB_ENGINE = create_engine(
-                sqlite_url,
-                connect_args={"check_same_thread": False},
-                poolclass=NullPool
-            )
+            _DB_ENGINE = _create_sqlite_engine()
             _DB_IS_POSTGRES = False
     return _DB_ENGINE
 
@@ -66,6 +226,43 @@ def is_postgres():
         get_db_engine()
     return _DB_IS_POSTGRES
 
+def _create_read_engine():
+    db_url = _normalize_database_url(DATABASE_READ_URL or DATABASE_URL)
+    connect_args = {}
+    if READ_DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["options"] = f"-c statement_timeout={READ_DB_STATEMENT_TIMEOUT_MS}"
+    return create_engine(
+        db_url,
+        pool_pre_ping=True,
+        pool_size=READ_DB_POOL_SIZE,
+        max_overflow=READ_DB_MAX_OVERFLOW,
+        connect_args=connect_args
+    )
+
+def get_read_engine():
+    """Engine for reads; the primary on SQLite and inside read_your_writes()"""
+    global _DB_READ_ENGINE
+    if not is_postgres() or _READ_YOUR_WRITES.get():
+        return get_db_engine()
+    if _DB_READ_ENGINE is None:
+        _DB_READ_ENGINE = _create_read_engine()
+    return _DB_READ_ENGINE
+
+@contextmanager
+def read_your_writes():
+    """Send reads in this block to the primary, for paths that must see what they just wrote"""
+    token = _READ_YOUR_WRITES.set(True)
+    try:
+        yield
+    finally:
+        _READ_YOUR_WRITES.reset(token)
+
+def _with_caller_context(fn):
+    """Wrap fn so executor threads run it in a copy of the caller's contextvars (read_your_writes)"""
+    ctx = contextvars.copy_context()
+    # One copy per call: a Context cannot be entered by two threads at once.
+    return lambda *args: ctx.copy().run(fn, *args)
+
 def get_db_target():
     if DATABASE_URL:
         parsed = urlparse(DATABASE_URL)
@@ -76,24 +273,36 @@ def get_db_target():
     return f"sqlite:///{DB_PATH}"
 
 def fetch_mappings(query, params=None):
-    engine = get_db_engine()
+    engine = get_read_engine()
     with engine.connect() as conn:
         result = conn.execute(text(query), params or {})
         return [dict(row) for row in result.mappings().all()]
 
 def fetch_mapping(query, params=None):
-    engine = get_db_engine()
+    engine = get_read_engine()
     with engine.connect() as conn:
         result = conn.execute(text(query), params or {})
         row = result.mappings().first()
         return dict(row) if row else None
 
 def fetch_scalar(query, params=None):
-    engine = get_db_engine()
+    engine = get_read_engine()
     with engine.connect() as conn:
         result = conn.execute(text(query), params or {})
         return result.scalar()
 
+def stream_rows(query, params=None, batch_size=None):
+    """Yield (columns, rows) batches off a server-side cursor; only one batch is held in memory"""
+    batch_size = batch_size or STREAM_BATCH_ROWS
+    engine = get_read_engine()
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(text(query), params or {})
+        columns = list(result.keys())
+        # yield_per as an execution option only applies to ORM statements;
+        # for text() the batch size has to be given to partitions().
+        for rows in result.partitions(batch_size):
+            yield columns, rows
+
 def execute_write(query, params=None):
     engine = get_db_engine()
     with engine.begin() as conn:
@@ -104,103 +313,761 @@ def execute_many(query, params_list):
     with engine.begin() as conn:
         conn.execute(text(query), params_list)
 
+# DISTRIBUTED LOCKS
+# Lease rows rather than pg_advisory_lock: session-level advisory locks do not
+# survive a transaction-mode pooler (Supabase/pgbouncer), and SQLite needs the
+# same mechanism anyway.
+_ACQUIRE_LOCK_SQL = """
+    INSERT INTO db_locks (name, owner, acquired_at, expires_at)
+    VALUES (:name, :owner, :now, :expires_at)
+    ON CONFLICT (name) DO UPDATE SET
+        owner = excluded.owner,
+        acquired_at = excluded.acquired_at,
+        expires_at = excluded.expires_at
+    WHERE db_locks.expires_at < :now OR db_locks.owner = excluded.owner
+"""
+
+def _lock_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def try_acquire_lock(name, owner, ttl_sec):
+    now = int(time.time() * 1000)
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        result = conn.execute(text(_ACQUIRE_LOCK_SQL), {
+            "name": name,
+            "owner": owner,
+            "now": now,
+            "expires_at": now + int(ttl_sec * 1000)
+        })
+        return result.rowcount > 0
+
+def renew_lock(name, owner, ttl_sec):
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        result = conn.execute(text(
+            "UPDATE db_locks SET expires_at = :expires_at WHERE name = :name AND owner = :owner"
+        ), {"name": name, "owner": owner, "expires_at": int(time.time() * 1000) + int(ttl_sec * 1000)})
+        return result.rowcount > 0
+
+def release_lock(name, owner):
+    execute_write("DELETE FROM db_locks WHERE name = :name AND owner = :owner", {"name": name, "owner": owner})
+
+def _heartbeat_lock(name, owner, ttl_sec, stop_event):
+    while not stop_event.wait(max(ttl_sec / 3.0, 1.0)):
+        try:
+            if not renew_lock(name, owner, ttl_sec):
+                print(f"Lost lock {name}; another process may take over")
+                return
+        except Exception as e:
+            print(f"Could not renew lock {name}: {e}")
+
+@contextmanager
+def db_lock(name, ttl_sec, wait_sec=0):
+    """Hold the named lease lock for the block; yields False if it could not be taken within wait_sec"""
+    owner = _lock_owner()
+    deadline = time.time() + wait_sec
+    acquired = try_acquire_lock(name, owner, ttl_sec)
+    while not acquired and time.time() < deadline:
+        time.sleep(min(0.5, max(deadline - time.time(), 0)))
+        acquired = try_acquire_lock(name, owner, ttl_sec)
+
+    if not acquired:
+        yield False
+        return
+
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat_lock,
+        args=(name, owner, ttl_sec, stop_event),
+        name=f"lock-{name}",
+        daemon=True
+    )
+    heartbeat.start()
+    try:
+        yield True
+    finally:
+        stop_event.set()
+        heartbeat.join(timeout=5)
+        try:
+            release_lock(name, owner)
+        except Exception as e:
+            print(f"Could not release lock {name}: {e}")
+
+_INSERT_CANDLES_SQL = """
+    INSERT INTO ohlcv_data
+    (symbol, timestamp, date, open, high, low, close, volume)
+    VALUES (:symbol, :timestamp, :date, :open, :high, :low, :close, :volume)
+    ON CONFLICT (symbol, timestamp) DO NOTHING
+"""
+
+_UPSERT_INGESTION_STATE_SQL = """
+    INSERT INTO ingestion_state
+    (symbol, first_ts, last_ts, row_count, last_checked_at, last_error)
+    VALUES (:symbol, :first_ts, :last_ts, :row_count, :checked_at, NULL)
+    ON CONFLICT (symbol) DO UPDATE SET
+        first_ts = CASE
+            WHEN ingestion_state.first_ts IS NULL OR EXCLUDED.first_ts < ingestion_state.first_ts
+            THEN EXCLUDED.first_ts ELSE ingestion_state.first_ts END,
+        last_ts = CASE
+            WHEN ingestion_state.last_ts IS NULL OR EXCLUDED.last_ts > ingestion_state.last_ts
+            THEN EXCLUDED.last_ts ELSE ingestion_state.last_ts END,
+        row_count = COALESCE(ingestion_state.row_count, 0) + EXCLUDED.row_count,
+        last_checked_at = EXCLUDED.last_checked_at,
+        last_error = NULL
+"""
+
+CANDLE_COLUMNS = ("symbol", "timestamp", "date", "open", "high", "low", "close", "volume")
+
+_STAGE_CANDLES_SQL = """
+    CREATE TEMP TABLE _ohlcv_stage (
+        symbol TEXT,
+        timestamp BIGINT,
+        date TEXT,
+        open DOUBLE PRECISION,
+        high DOUBLE PRECISION,
+        low DOUBLE PRECISION,
+        close DOUBLE PRECISION,
+        volume DOUBLE PRECISION
+    ) ON COMMIT DROP
+"""
+
+# One set-based statement: merge the staged candles and fold the per-pair
+# min/max/inserted counts into ingestion_state.
+_MERGE_STAGED_CANDLES_SQL = """
+    WITH inserted AS (
+        INSERT INTO ohlcv_data (symbol, timestamp, date, open, high, low, close, volume)
+        SELECT symbol, timestamp, date, open, high, low, close, volume FROM _ohlcv_stage
+        ON CONFLICT (symbol, timestamp) DO NOTHING
+        RETURNING symbol
+    ),
+    inserted_counts AS (
+        SELECT symbol, COUNT(*) AS n FROM inserted GROUP BY symbol
+    ),
+    batch AS (
+        SELECT symbol, MIN(timestamp) AS first_ts, MAX(timestamp) AS last_ts
+        FROM _ohlcv_stage GROUP BY symbol
+    )
+    INSERT INTO ingestion_state
+    (symbol, first_ts, last_ts, row_count, last_checked_at, last_error)
+    SELECT b.symbol, b.first_ts, b.last_ts, COALESCE(c.n, 0), :checked_at, NULL
+    FROM batch b LEFT JOIN inserted_counts c ON c.symbol = b.symbol
+    ON CONFLICT (symbol) DO UPDATE SET
+        first_ts = CASE
+            WHEN ingestion_state.first_ts IS NULL OR EXCLUDED.first_ts < ingestion_state.first_ts
+            THEN EXCLUDED.first_ts ELSE ingestion_state.first_ts END,
+        last_ts = CASE
+            WHEN ingestion_state.last_ts IS NULL OR EXCLUDED.last_ts > ingestion_state.last_ts
+            THEN EXCLUDED.last_ts ELSE ingestion_state.last_ts END,
+        row_count = COALESCE(ingestion_state.row_count, 0) + EXCLUDED.row_count,
+        last_checked_at = EXCLUDED.last_checked_at,
+        last_error = NULL
+"""
+
+def _group_candles_by_symbol(candles):
+    groups = {}
+    for c in candles:
+        groups.setdefault(c[0], []).append(c)
+    return groups
+
+def _sqlite_batch_rows():
+    # SQLite caps bound parameters per statement (999 before 3.32).
+    max_vars = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    return max(min(OHLCV_INSERT_BATCH_ROWS, max_vars // len(CANDLE_COLUMNS)), 1)
+
+def _insert_candles_multirow(conn, rows):
+    batch_rows = _sqlite_batch_rows()
+    row_sql = "(" + ", ".join("?" * len(CANDLE_COLUMNS)) + ")"
+    inserted = 0
+    for i in range(0, len(rows), batch_rows):
+        part = rows[i:i + batch_rows]
+        params = []
+        for c in part:
+            params.extend(c)
+        result = conn.exec_driver_sql(
+            f"INSERT INTO ohlcv_data ({', '.join(CANDLE_COLUMNS)}) VALUES "
+            + ", ".join([row_sql] * len(part))
+            + " ON CONFLICT (symbol, timestamp) DO NOTHING",
+            tuple(params)
+        )
+        inserted += result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(part)
+    return inserted
+
+def _copy_candles_postgres(conn, candles, checked_at):
+    conn.execute(text(_STAGE_CANDLES_SQL))
+    # COPY runs on the same psycopg connection, inside the SQLAlchemy transaction.
+    driver_conn = conn.connection.driver_connection
+    with driver_conn.cursor() as cur:
+        with cur.copy(f"COPY _ohlcv_stage ({', '.join(CANDLE_COLUMNS)}) FROM STDIN") as copy:
+            for c in candles:
+                copy.write_row(c)
+    conn.execute(text(_MERGE_STAGED_CANDLES_SQL), {"checked_at": checked_at})
+
 def _save_candles(candles):
+    """candles: tuples ordered like CANDLE_COLUMNS"""
     if not candles:
         return
-    execute_many("""
-        INSERT INTO ohlcv_data
-        (symbol, timestamp, date, open, high, low, close, volume)
-        VALUES (:symbol, :timestamp, :date, :open, :high, :low, :close, :volume)
-        ON CONFLICT (symbol, timestamp) DO NOTHING
-    """, candles)
+    checked_at = int(time.time() * 1000)
+    engine = get_db_engine()
+    postgres = is_postgres()
+    # Candles and the per-pair watermark commit together, so ingestion_state
+    # never points past rows that are not in ohlcv_data.
+    with engine.begin() as conn:
+        if postgres and OHLCV_COPY_WRITES:
+            _copy_candles_postgres(conn, candles, checked_at)
+            return
+
+        for symbol, rows in _group_candles_by_symbol(candles).items():
+            if postgres:
+                result = conn.execute(
+                    text(_INSERT_CANDLES_SQL),
+                    [dict(zip(CANDLE_COLUMNS, r)) for r in rows]
+                )
+                inserted = result.rowcount if result.rowcount is not None and result.rowcount >= 0 else len(rows)
+            else:
+                inserted = _insert_candles_multirow(conn, rows)
+            timestamps = [r[1] for r in rows]
+            conn.execute(text(_UPSERT_INGESTION_STATE_SQL), {
+                "symbol": symbol,
+                "first_ts": min(timestamps),
+                "last_ts": max(timestamps),
+                "row_count": inserted,
+                "checked_at": checked_at
+            })
 
-def _fetch_binance_candles(pair, start_ms, end_ms, binance_base=None):
-    base = (binance_base or _ACTIVE_BINANCE_BASE or BINANCE_BASE).rstrip("/")
-    candles = []
+# Watermarks decide what to fetch next, so they are always read from the
+# primary; a lagging replica would only cause refetches.
+def get_ingestion_state(pair):
+    with read_your_writes():
+        return fetch_mapping(
+            "SELECT * FROM ingestion_state WHERE symbol = :symbol",
+            {"symbol": pair}
+        )
+
+def load_ingestion_states():
+    with read_your_writes():
+        rows = fetch_mappings("SELECT * FROM ingestion_state")
+    return {row["symbol"]: row for row in rows}
+
+def record_ingestion_checks(checks):
+    """checks: iterable of (pair, error_or_None) from one fetch attempt each"""
+    checked_at = int(time.time() * 1000)
+    params = [
+        {"symbol": pair, "checked_at": checked_at, "error": (error or None) and str(error)[:500]}
+        for pair, error in checks
+    ]
+    if not params:
+        return
+    execute_many("""
+        INSERT INTO ingestion_state (symbol, row_count, last_checked_at, last_error)
+        VALUES (:symbol, 0, :checked_at, :error)
+        ON CONFLICT (symbol) DO UPDATE SET
+            last_checked_at = EXCLUDED.last_checked_at,
+            last_error = EXCLUDED.last_error
+    """, params)
+
+def _ensure_column(conn, table, column, ddl):
+    # CREATE TABLE IF NOT EXISTS does not add columns to tables created by
+    # an earlier version of this module.
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def _bootstrap_ingestion_state(conn):
+    # One-off seed for databases that already hold candles from before the
+    # ingestion_state table existed.
+    if conn.execute(text("SELECT 1 FROM ingestion_state LIMIT 1")).first():
+        return
+    if not conn.execute(text("SELECT 1 FROM ohlcv_data LIMIT 1")).first():
+        return
+    print("Seeding ingestion_state from ohlcv_data")
+    conn.execute(text("""
+        INSERT INTO ingestion_state (symbol, first_ts, last_ts, row_count, last_checked_at, last_error)
+        SELECT symbol, MIN(timestamp), MAX(timestamp), COUNT(*), NULL, NULL
+        FROM ohlcv_data
+        GROUP BY symbol
+        ON CONFLICT (symbol) DO NOTHING
+    """))
+
+def _parse_kline_page(pair, chunk):
+    """Turn one klines page into candle tuples ordered like CANDLE_COLUMNS"""
+    n = len(chunk)
+    opens = np.fromiter((k[0] for k in chunk), dtype=np.int64, count=n)
+    prices = np.array([k[1:6] for k in chunk], dtype=np.float64)
+    # Binance daily candles open at 00:00 UTC, so the UTC day is the label.
+    dates = opens.astype("datetime64[ms]").astype("datetime64[D]").astype(str)
+    return list(zip(
+        [pair] * n,
+        opens.tolist(),
+        dates.tolist(),
+        prices[:, 0].tolist(),
+        prices[:, 1].tolist(),
+        prices[:, 2].tolist(),
+        prices[:, 3].tolist(),
+        prices[:, 4].tolist()
+    ))
+
+def _probe_first_candle_ms(pair, base):
+    r = http_get(
+        base + "/api/v3/klines",
+        params={"symbol": pair, "interval": "1d", "startTime": 0, "limit": 1},
+        timeout=10,
+        cost=KLINES_WEIGHT
+    )
+    if r.status_code != 200:
+        print(f"Binance klines error ({base}): status={r.status_code} body={r.text[:200]}")
+        return None
+    chunk = r.json()
+    if not isinstance(chunk, list) or len(chunk) == 0:
+        return -1
+    return int(chunk[0][0])
+
+def _shard_windows(first_ms, end_ms):
+    # Each window holds exactly one kline page; the window end is the open
+    # time of its last candle so the page loop never asks for an empty page.
+    step = KLINES_LIMIT * DAY_MS
+    return [
+        (w, min(w + (KLINES_LIMIT - 1) * DAY_MS, end_ms))
+        for w in range(first_ms, end_ms + 1, step)
+    ]
+
+def _iter_binance_pages(pair, start_ms, end_ms, base):
     cursor = start_ms
 
-    while cursor < end_ms:
-        r = requests.get(
+    while cursor <= end_ms:
+        r = http_get(
             base + "/api/v3/klines",
             params={
                 "symbol": pair,
                 "interval": "1d",
                 "startTime": cursor,
                 "endTime": end_ms,
-                "limit": 1000
+                "limit": KLINES_LIMIT
             },
-            timeout=10
+            timeout=10,
+            cost=KLINES_WEIGHT
         )
 
         if r.status_code != 200:
             print(f"Binance klines error ({base}): status={r.status_code} body={r.text[:200]}")
-            return None
+            raise RuntimeError(f"Binance klines request failed (status={r.status_code})")
 
         chunk = r.json()
         if not isinstance(chunk, list) or len(chunk) == 0:
-            break
+            return
 
-        for k in chunk:
-            candles.append({
-                "symbol": pair,
-                "timestamp": int(k[0]),
-                "date": dt.datetime.fromtimestamp(k[0] / 1000).strftime("%Y-%m-%d"),
-                "open": float(k[1]),
-                "high": float(k[2]),
-                "low": float(k[3]),
-                "close": float(k[4]),
-                "volume": float(k[5])
-            })
+        yield _parse_kline_page(pair, chunk)
 
         cursor = int(chunk[-1][0]) + 1
-        if len(chunk) < 1000:
-            break
+        if len(chunk) < KLINES_LIMIT:
+            return
+
+def _iter_binance_pages_sharded(pair, start_ms, end_ms, base):
+    first_ms = _probe_first_candle_ms(pair, base)
+    if first_ms is None:
+        raise RuntimeError("Binance klines probe failed")
+    if first_ms < 0:
+        return
 
-    return candles
+    windows = _shard_windows(max(start_ms, first_ms), end_ms)
+    if len(windows) <= 1:
+        yield from _iter_binance_pages(pair, max(start_ms, first_ms), end_ms, base)
+        return
 
-def backfill_ohlcv(symbol, start_ms=0, end_ms=None):
-    pair = symbol.upper() + "USDT"
-    end_ms = end_ms or int(time.time() * 1000)
+    workers = max(min(BINANCE_BACKFILL_WORKERS, len(windows)), 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [
+            ex.submit(lambda w: list(_iter_binance_pages(pair, w[0], w[1], base)), w)
+            for w in windows
+        ]
+        # Windows are fetched concurrently but handed on in time order.
+        for future in futures:
+            yield from future.result()
+
+def iter_binance_candles(pair, start_ms, end_ms, binance_base=None, sharded=None):
+    """Yield [start_ms, end_ms] one page of candle tuples at a time; raises on request failure"""
+    base = (binance_base or _ACTIVE_BINANCE_BASE or BINANCE_BASE).rstrip("/")
+    if sharded is None:
+        sharded = BINANCE_SHARDED_BACKFILL and start_ms <= 0
+    # Expired history is not fetched back in.
+    start_ms = max(start_ms, ohlcv_retention_cutoff_ms())
+    if sharded:
+        return _iter_binance_pages_sharded(pair, start_ms, end_ms, base)
+    return _iter_binance_pages(pair, start_ms, end_ms, base)
+
+def stream_candles_to_db(pair, start_ms, end_ms, binance_base=None):
+    """Fetch and save page by page; returns (candles saved, error or None)"""
+    saved = 0
+    try:
+        for page in iter_binance_candles(pair, start_ms, end_ms, binance_base):
+            _save_candles(page)
+            saved += len(page)
+    except Exception as e:
+        return saved, e
+    return saved, None
+
+def _backfill_pair(pair, start_ms, end_ms):
+    """Fetch and save [start_ms, end_ms]; returns candles saved, or None on failure"""
     binance = get_binance_symbols()
     if pair not in binance:
         print(f"Binance pair missing: {pair}")
-        return 0
-    candles = _fetch_binance_candles(pair, start_ms, end_ms)
+        return None
+    saved, error = stream_candles_to_db(pair, start_ms, end_ms)
+    if error is not None:
+        print(f"OHLCV backfill failed for {pair} after {saved} candles: {error}")
+        record_ingestion_checks([(pair, error)])
+        return None
+    return saved
 
-    if candles:
-        _save_candles(candles)
-        return len(candles)
-    return 0
+def backfill_ohlcv(symbol, start_ms=0, end_ms=None):
+    pair = symbol.upper() + "USDT"
+    end_ms = end_ms or int(time.time() * 1000)
+    return _backfill_pair(pair, start_ms, end_ms) or 0
+
+def mark_history_complete(pairs):
+    params = [{"symbol": pair} for pair in pairs]
+    if params:
+        execute_many(
+            "UPDATE ingestion_state SET history_complete = 1 WHERE symbol = :symbol",
+            params
+        )
+
+def ohlcv_day(date_text):
+    """Day number (ohlcv_data.day) of a YYYY-MM-DD date"""
+    return (dt.date.fromisoformat(date_text) - dt.date(1970, 1, 1)).days
+
+def ohlcv_cutoff_day(days, now_ms=None):
+    """Day number (ohlcv_data.day) of the first candle in a window of the last `days` days"""
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    return now_ms // DAY_MS - int(days)
+
+def _year_start_ms(year):
+    return int(dt.datetime(year, 1, 1, tzinfo=dt.timezone.utc).timestamp() * 1000)
+
+def ohlcv_retention_cutoff_ms(now_ms=None):
+    """Open time of the oldest candle kept under OHLCV_RETENTION_YEARS (0 when history is unbounded)"""
+    if OHLCV_RETENTION_YEARS <= 0:
+        return 0
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    year = dt.datetime.fromtimestamp(now_ms / 1000, dt.timezone.utc).year
+    return _year_start_ms(year - OHLCV_RETENTION_YEARS)
+
+def last_closed_candle_ms(now_ms=None):
+    """Open time of the most recent daily candle that has already closed"""
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    return (now_ms // DAY_MS) * DAY_MS - DAY_MS
+
+def is_ohlcv_fresh(state, now_ms=None):
+    if not state or state.get("last_ts") is None:
+        return False
+    last_closed = last_closed_candle_ms(now_ms)
+    if state["last_ts"] >= last_closed - OHLCV_STALENESS_TOLERANCE_SEC * 1000:
+        return True
+    # Already asked Binance successfully after that candle closed (e.g. a
+    # delisted pair); asking again before the next close cannot return
+    # anything new. A failed check proves nothing, so it is retried.
+    if state.get("last_error"):
+        return False
+    return (state.get("last_checked_at") or 0) >= last_closed + DAY_MS
+
+def _run_background_backfill(symbol):
+    try:
+        ensure_ohlcv_data(symbol)
+    except Exception as e:
+        print(f"Background backfill failed for {symbol}: {e}")
+    finally:
+        with _BACKGROUND_BACKFILL_LOCK:
+            _BACKGROUND_BACKFILL_PENDING.discard(symbol)
+
+def schedule_background_backfill(symbol):
+    global _BACKGROUND_BACKFILL_EXECUTOR
+    symbol = symbol.upper()
+    with _BACKGROUND_BACKFILL_LOCK:
+        if symbol in _BACKGROUND_BACKFILL_PENDING:
+            return False
+        if _BACKGROUND_BACKFILL_EXECUTOR is None:
+            _BACKGROUND_BACKFILL_EXECUTOR = ThreadPoolExecutor(
+                max_workers=max(OHLCV_BACKGROUND_WORKERS, 1),
+                thread_name_prefix="ohlcv-backfill"
+            )
+        _BACKGROUND_BACKFILL_PENDING.add(symbol)
+    _BACKGROUND_BACKFILL_EXECUTOR.submit(_run_background_backfill, symbol)
+    return True
+
+def _ohlcv_fetch_needed(state, max_days, now_ms):
+    """Whether ensure_ohlcv_data has to call Binance inline for this ingestion_state row"""
+    if not state or state.get("first_ts") is None:
+        return True
+    if not state.get("history_complete") and not max_days:
+        return True
+    return not is_ohlcv_fresh(state, now_ms)
 
 def ensure_ohlcv_data(symbol, max_days=None):
     pair = symbol.upper() + "USDT"
+    # Fresh pairs cost one read: no lease, no writes.
+    state = get_ingestion_state(pair)
+    if not _ohlcv_fetch_needed(state, max_days, int(time.time() * 1000)):
+        if not state.get("history_complete"):
+            schedule_background_backfill(symbol)
+        return 0
+
+    # One on-demand fetcher per pair across the deployment; a request that
+    # waited for another process re-reads the state that process left behind.
+    # Pipeline runs do not take this lease; an overlapping fetch only
+    # re-inserts candles that ON CONFLICT drops.
+    with db_lock(f"ohlcv:{pair}", OHLCV_LOCK_TTL_SEC, wait_sec=OHLCV_LOCK_WAIT_SEC) as acquired:
+        if not acquired:
+            print(f"OHLCV backfill for {pair} still running elsewhere; serving stored data")
+            return 0
+        return _ensure_ohlcv_data_locked(symbol, pair, max_days)
+
+def _ensure_ohlcv_data_locked(symbol, pair, max_days):
     now_ms = int(time.time() * 1000)
 
-    row = fetch_mapping(
-        "SELECT MIN(timestamp) AS min_ts, MAX(timestamp) AS max_ts FROM ohlcv_data WHERE symbol = :symbol",
-        {"symbol": pair}
-    )
+    row = get_ingestion_state(pair)
 
-    min_ts = row["min_ts"] if row else None
-    max_ts = row["max_ts"] if row else None
+    min_ts = row["first_ts"] if row else None
+    max_ts = row["last_ts"] if row else None
+    history_complete = bool(row and row.get("history_complete"))
     total = 0
 
+    if min_ts is None and max_days:
+        # Serve the requested window now; the rest of the history follows
+        # in the background and is marked complete there.
+        window_start = (now_ms // DAY_MS - int(max_days)) * DAY_MS
+        saved = _backfill_pair(pair, window_start, now_ms)
+        if saved is not None:
+            record_ingestion_checks([(pair, None)])
+            schedule_background_backfill(symbol)
+        return saved or 0
+
     if min_ts is None:
-        total += backfill_ohlcv(symbol, start_ms=0, end_ms=now_ms)
-    else:
-        if min_ts > 0:
-            total += backfill_ohlcv(symbol, start_ms=0, end_ms=min_ts - 1)
-        if max_ts and max_ts + 86400000 < now_ms:
-            total += backfill_ohlcv(symbol, start_ms=max_ts + 1, end_ms=now_ms)
+        saved = _backfill_pair(pair, 0, now_ms)
+        if saved is not None:
+            total += saved
+            record_ingestion_checks([(pair, None)])
+            if saved:
+                mark_history_complete([pair])
+        return total
+
+    if not history_complete and max_days:
+        schedule_background_backfill(symbol)
+    elif not history_complete:
+        saved = _backfill_pair(pair, 0, min_ts - 1)
+        if saved is not None:
+            total += saved
+            mark_history_complete([pair])
+
+    if not is_ohlcv_fresh(row, now_ms):
+        saved = _backfill_pair(pair, max_ts + 1, now_ms)
+        if saved is not None:
+            total += saved
+            record_ingestion_checks([(pair, None)])
 
     return total
 
 
 
+# GAP DETECTION
+# One pass over (symbol, timestamp): LEAD() pairs each candle with the next
+# one, and any step longer than a day is a hole. Holes Binance already
+# answered with nothing (trading halts) are kept in ohlcv_known_gaps.
+_FIND_GAPS_SQL = """
+    SELECT g.symbol, g.timestamp + :day_ms AS start_ts, g.next_ts - :day_ms AS end_ts
+    FROM (
+        SELECT symbol, timestamp,
+               LEAD(timestamp) OVER (PARTITION BY symbol ORDER BY timestamp) AS next_ts
+        FROM ohlcv_data
+        {where}
+    ) g
+    WHERE g.next_ts - g.timestamp > :day_ms
+      AND NOT EXISTS (
+          SELECT 1 FROM ohlcv_known_gaps k
+          WHERE k.symbol = g.symbol AND k.start_ts = g.timestamp + :day_ms
+      )
+    ORDER BY g.symbol, g.timestamp
+"""
+
+def find_ohlcv_gaps(pairs=None, limit=None):
+    """Missing daily candle ranges as [(pair, start_ms, end_ms)], both ends inclusive"""
+    params = {"day_ms": DAY_MS}
+    where = ""
+    if pairs is not None:
+        pairs = list(pairs)
+        if not pairs:
+            return []
+        names = [f"p{i}" for i in range(len(pairs))]
+        where = "WHERE symbol IN (" + ", ".join(f":{n}" for n in names) + ")"
+        params.update(zip(names, pairs))
+    query = _FIND_GAPS_SQL.format(where=where)
+    if limit:
+        query += " LIMIT :limit"
+        params["limit"] = int(limit)
+    rows = fetch_mappings(query, params)
+    return [(row["symbol"], int(row["start_ts"]), int(row["end_ts"])) for row in rows]
+
+def _record_known_gaps(gaps):
+    params = [
+        {"symbol": pair, "start_ts": start_ms, "end_ts": end_ms, "checked_at": int(time.time() * 1000)}
+        for pair, start_ms, end_ms in gaps
+    ]
+    if params:
+        execute_many("""
+            INSERT INTO ohlcv_known_gaps (symbol, start_ts, end_ts, checked_at)
+            VALUES (:symbol, :start_ts, :end_ts, :checked_at)
+            ON CONFLICT (symbol, start_ts) DO UPDATE SET
+                end_ts = excluded.end_ts,
+                checked_at = excluded.checked_at
+        """, params)
+
+def repair_ohlcv_gaps(pairs=None, limit=OHLCV_GAP_REPAIR_MAX):
+    """Refetch only the missing ranges inside stored series"""
+    gaps = find_ohlcv_gaps(pairs, limit)
+    if not gaps:
+        return {"gaps_found": 0, "gaps_filled": 0, "candles": 0}
+    print(f"Repairing {len(gaps)} OHLCV gaps")
+
+    def repair(gap):
+        pair, start_ms, end_ms = gap
+        saved, error = stream_candles_to_db(pair, start_ms, end_ms)
+        if error is not None:
+            print(f"OHLCV gap repair failed for {pair} ({start_ms}-{end_ms}): {error}")
+        return saved, error
+
+    with ThreadPoolExecutor(max_workers=max(BINANCE_WORKERS, 1)) as ex:
+        outcomes = list(ex.map(_with_caller_context(repair), gaps))
+
+    # Nothing on Binance for the range: remember it so later scans skip it.
+    _record_known_gaps([
+        gap for gap, (saved, error) in zip(gaps, outcomes)
+        if error is None and saved == 0
+    ])
+    filled = sum(1 for saved, error in outcomes if error is None and saved)
+    candles = sum(saved for saved, _ in outcomes)
+    print(f"OHLCV gaps filled: {filled}/{len(gaps)} ({candles} candles)")
+    return {"gaps_found": len(gaps), "gaps_filled": filled, "candles": candles}
+
+
+# PAIR DEMAND
+def record_pair_requests(counts):
+    """Add API hits per pair ({pair: hits}) to today's bucket"""
+    day = int(time.time() * 1000) // DAY_MS
+    params = [{"symbol": pair, "day": day, "requests": hits} for pair, hits in counts.items() if hits]
+    if not params:
+        return
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO pair_requests (symbol, day, requests)
+            VALUES (:symbol, :day, :requests)
+            ON CONFLICT (symbol, day) DO UPDATE SET requests = pair_requests.requests + excluded.requests
+        """), params)
+        conn.execute(text("DELETE FROM pair_requests WHERE day < :cutoff"), {"cutoff": day - DEMAND_WINDOW_DAYS})
+
+def set_pair_memberships(memberships):
+    """Replace watcher/holder/alert counts; memberships maps pair -> (watchers, holders, alerts)"""
+    now = int(time.time() * 1000)
+    params = [
+        {"symbol": pair, "watchers": w, "holders": h, "alerts": a, "updated_at": now}
+        for pair, (w, h, a) in memberships.items()
+    ]
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM pair_memberships"))
+        if params:
+            conn.execute(text("""
+                INSERT INTO pair_memberships (symbol, watchers, holders, alerts, updated_at)
+                VALUES (:symbol, :watchers, :holders, :alerts, :updated_at)
+            """), params)
+
+def load_pair_priorities():
+    """Demand score per pair; pairs nobody watches or requests are absent"""
+    today = int(time.time() * 1000) // DAY_MS
+    rows = fetch_mappings("""
+        SELECT symbol, SUM(score) AS score
+        FROM (
+            SELECT symbol, watchers * :w + holders * :h + alerts * :a AS score
+            FROM pair_memberships
+            UNION ALL
+            SELECT symbol, requests * 1.0 / (1 + :today - day) AS score
+            FROM pair_requests
+            WHERE day >= :since
+        ) demand
+        GROUP BY symbol
+    """, {
+        "w": DEMAND_WATCHLIST_WEIGHT,
+        "h": DEMAND_PORTFOLIO_WEIGHT,
+        "a": DEMAND_NOTIFICATION_WEIGHT,
+        "today": today,
+        "since": today - DEMAND_WINDOW_DAYS
+    })
+    return {row["symbol"]: float(row["score"] or 0) for row in rows if row["score"]}
+
+def prioritize_pairs(coins, priorities=None, now_ms=None):
+    """Order pairs hottest first and drop long-tail pairs checked cleanly within OHLCV_TAIL_REFRESH_SEC"""
+    priorities = load_pair_priorities() if priorities is None else priorities
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    tail_cutoff = now_ms - OHLCV_TAIL_REFRESH_SEC * 1000
+
+    ordered = []
+    deferred = 0
+    for coin in coins:
+        score = priorities.get(coin["binance_pair"], 0.0)
+        coin["priority"] = score
+        checked_at = coin.get("last_checked_at") or 0
+        # A pair whose last fetch failed is retried on the next run.
+        if (not score and OHLCV_TAIL_REFRESH_SEC and coin.get("last_timestamp")
+                and not coin.get("last_error") and checked_at >= tail_cutoff):
+            deferred += 1
+            continue
+        ordered.append(coin)
+
+    # Stable sort keeps market-cap order among equally scored pairs.
+    ordered.sort(key=lambda c: -c["priority"])
+    hot = sum(1 for c in ordered if c["priority"] >= OHLCV_HOT_MIN_SCORE)
+    print(f"Pair priority: {hot} hot, {len(ordered) - hot} other, {deferred} long-tail deferred")
+    return ordered
+
+def refresh_hot_pairs():
+    """Top up stale hot pairs between pipeline runs; returns candles saved"""
+    priorities = load_pair_priorities()
+    hot = sorted(
+        (pair for pair, score in priorities.items() if score >= OHLCV_HOT_MIN_SCORE),
+        key=lambda pair: -priorities[pair]
+    )[:OHLCV_HOT_MAX_PAIRS]
+    if not hot:
+        return 0
+
+    states = load_ingestion_states()
+    now_ms = int(time.time() * 1000)
+    stale = [pair for pair in hot if not is_ohlcv_fresh(states.get(pair), now_ms)]
+    if not stale:
+        return 0
+
+    binance = get_binance_symbols()
+    coins = [
+        {
+            "binance_pair": pair,
+            "binance_base": _ACTIVE_BINANCE_BASE,
+            "last_timestamp": states[pair]["last_ts"] if pair in states else None
+        }
+        for pair in stale if pair in binance
+    ]
+    if not coins:
+        return 0
+
+    # Shares the pipeline lock: a running pipeline already does hot pairs first.
+    with db_lock("pipeline", PIPELINE_LOCK_TTL_SEC) as acquired:
+        if not acquired:
+            return 0
+        print(f"Refreshing {len(coins)} hot pairs")
+        return filter_3_fill_missing_data(coins)["candles"]
+
+
 # INIT DATABASE (табели: top_coins, meta_info, ohlcv_data)
-def init_db():
-    if is_postgres():
-        statements = [
+def _baseline_statements(postgres):
+    if postgres:
+        return [
             """
             CREATE TABLE IF NOT EXISTS top_coins (
                 coin_id TEXT PRIMARY KEY,
@@ -216,7 +1083,10 @@ def init_db():
             """
             CREATE TABLE IF NOT EXISTS meta_info (
                 id INTEGER PRIMARY KEY,
-                last_top1000_update TEXT
+                last_top1000_update TEXT,
+                last_price_refresh TEXT,
+                top_coins_snapshot TEXT,
+                schema_version INTEGER DEFAULT 0
             )
             """,
             """
@@ -238,50 +1108,590 @@ def init_db():
                 UNIQUE(symbol, timestamp)
             )
             """,
-            "CREATE INDEX IF NOT EXISTS idx_st ON ohlcv_data(symbol, timestamp)"
-        ]
-    else:
-        statements = [
+            "CREATE INDEX IF NOT EXISTS idx_st ON ohlcv_data(symbol, timestamp)",
             """
-            CREATE TABLE IF NOT EXISTS top_coins (
-                coin_id TEXT PRIMARY KEY,
-                symbol TEXT,
-                name TEXT,
-                market_cap_rank INT,
-                price REAL,
-                market_cap REAL,
-                volume_24h REAL,
-                liquidity_score REAL
+            CREATE TABLE IF NOT EXISTS ingestion_state (
+                symbol TEXT PRIMARY KEY,
+                first_ts BIGINT,
+                last_ts BIGINT,
+                row_count BIGINT DEFAULT 0,
+                last_checked_at BIGINT,
+                last_error TEXT,
+                history_complete INTEGER DEFAULT 0
             )
             """,
             """
-            CREATE TABLE IF NOT EXISTS meta_info (
+            CREATE TABLE IF NOT EXISTS binance_symbols (
                 id INTEGER PRIMARY KEY,
-                last_top1000_update TEXT
+                base TEXT,
+                symbols TEXT,
+                fetched_at DOUBLE PRECISION
             )
             """,
-            "INSERT OR IGNORE INTO meta_info (id, last_top1000_update) VALUES (1, NULL)",
             """
-            CREATE TABLE IF NOT EXISTS ohlcv_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE IF NOT EXISTS pipeline_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT,
+                source TEXT,
+                requested_at BIGINT,
+                started_at BIGINT,
+                finished_at BIGINT,
+                worker TEXT,
+                stats TEXT,
+                error TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_pipeline_jobs_status ON pipeline_jobs(status, requested_at)",
+            """
+            CREATE TABLE IF NOT EXISTS db_locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                acquired_at BIGINT,
+                expires_at BIGINT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pipeline_runs (
+                id TEXT PRIMARY KEY,
+                job_id TEXT,
+                status TEXT,
+                started_at BIGINT,
+                finished_at BIGINT,
+                duration_sec DOUBLE PRECISION,
+                filter1_sec DOUBLE PRECISION,
+                filter2_sec DOUBLE PRECISION,
+                filter3_sec DOUBLE PRECISION,
+                repair_sec DOUBLE PRECISION,
+                gaps_found INTEGER,
+                gaps_filled INTEGER,
+                coins_fetched INTEGER,
+                binance_pairs INTEGER,
+                candles_added BIGINT,
+                pairs_failed INTEGER,
+                candles_per_sec DOUBLE PRECISION,
+                http_requests BIGINT,
+                http_retries BIGINT,
+                http_throttled BIGINT,
+                http_errors BIGINT,
+                http_bytes BIGINT,
+                ingest_mode TEXT,
+                concurrency INTEGER,
+                stage TEXT,
+                snapshot_id TEXT,
+                attempts INTEGER DEFAULT 1,
+                error TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_pipeline_runs_started ON pipeline_runs(started_at)",
+            """
+            CREATE TABLE IF NOT EXISTS pipeline_run_pairs (
+                run_id TEXT,
                 symbol TEXT,
-                timestamp INT,
-                date TEXT,
-                open REAL,
-                high REAL,
-                low REAL,
-                close REAL,
-                volume REAL,
-                UNIQUE(symbol, timestamp)
+                candles INTEGER,
+                seconds DOUBLE PRECISION,
+                error TEXT
             )
             """,
-            "CREATE INDEX IF NOT EXISTS idx_st ON ohlcv_data(symbol, timestamp)"
+            "CREATE INDEX IF NOT EXISTS idx_pipeline_run_pairs_run ON pipeline_run_pairs(run_id)",
+            """
+            CREATE TABLE IF NOT EXISTS ohlcv_known_gaps (
+                symbol TEXT,
+                start_ts BIGINT,
+                end_ts BIGINT,
+                checked_at BIGINT,
+                PRIMARY KEY (symbol, start_ts)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pair_requests (
+                symbol TEXT,
+                day INTEGER,
+                requests INTEGER,
+                PRIMARY KEY (symbol, day)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pair_memberships (
+                symbol TEXT PRIMARY KEY,
+                watchers INTEGER DEFAULT 0,
+                holders INTEGER DEFAULT 0,
+                alerts INTEGER DEFAULT 0,
+                updated_at BIGINT
+            )
+            """
         ]
+    return [
+        """
+        CREATE TABLE IF NOT EXISTS top_coins (
+            coin_id TEXT PRIMARY KEY,
+            symbol TEXT,
+            name TEXT,
+            market_cap_rank INT,
+            price REAL,
+            market_cap REAL,
+            volume_24h REAL,
+            liquidity_score REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS meta_info (
+            id INTEGER PRIMARY KEY,
+            last_top1000_update TEXT,
+            last_price_refresh TEXT,
+            top_coins_snapshot TEXT,
+            schema_version INTEGER DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO meta_info (id, last_top1000_update) VALUES (1, NULL)",
+        """
+        CREATE TABLE IF NOT EXISTS ohlcv_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            symbol TEXT,
+            timestamp INT,
+            date TEXT,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            UNIQUE(symbol, timestamp)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_st ON ohlcv_data(symbol, timestamp)",
+        """
+        CREATE TABLE IF NOT EXISTS ingestion_state (
+            symbol TEXT PRIMARY KEY,
+            first_ts INT,
+            last_ts INT,
+            row_count INT DEFAULT 0,
+            last_checked_at INT,
+            last_error TEXT,
+            history_complete INT DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS binance_symbols (
+            id INTEGER PRIMARY KEY,
+            base TEXT,
+            symbols TEXT,
+            fetched_at REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT,
+            source TEXT,
+            requested_at INT,
+            started_at INT,
+            finished_at INT,
+            worker TEXT,
+            stats TEXT,
+            error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pipeline_jobs_status ON pipeline_jobs(status, requested_at)",
+        """
+        CREATE TABLE IF NOT EXISTS db_locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            acquired_at INT,
+            expires_at INT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_runs (
+            id TEXT PRIMARY KEY,
+            job_id TEXT,
+            status TEXT,
+            started_at INT,
+            finished_at INT,
+            duration_sec REAL,
+            filter1_sec REAL,
+            filter2_sec REAL,
+            filter3_sec REAL,
+            repair_sec REAL,
+            gaps_found INT,
+            gaps_filled INT,
+            coins_fetched INT,
+            binance_pairs INT,
+            candles_added INT,
+            pairs_failed INT,
+            candles_per_sec REAL,
+            http_requests INT,
+            http_retries INT,
+            http_throttled INT,
+            http_errors INT,
+            http_bytes INT,
+            ingest_mode TEXT,
+            concurrency INT,
+            stage TEXT,
+            snapshot_id TEXT,
+            attempts INT DEFAULT 1,
+            error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pipeline_runs_started ON pipeline_runs(started_at)",
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_run_pairs (
+            run_id TEXT,
+            symbol TEXT,
+            candles INT,
+            seconds REAL,
+            error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pipeline_run_pairs_run ON pipeline_run_pairs(run_id)",
+        """
+        CREATE TABLE IF NOT EXISTS ohlcv_known_gaps (
+            symbol TEXT,
+            start_ts INT,
+            end_ts INT,
+            checked_at INT,
+            PRIMARY KEY (symbol, start_ts)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pair_requests (
+            symbol TEXT,
+            day INT,
+            requests INT,
+            PRIMARY KEY (symbol, day)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pair_memberships (
+            symbol TEXT PRIMARY KEY,
+            watchers INT DEFAULT 0,
+            holders INT DEFAULT 0,
+            alerts INT DEFAULT 0,
+            updated_at INT
+        )
+        """
+    ]
+
+
+# SCHEMA MIGRATIONS
+# Applied in order, each at most once; meta_info.schema_version holds the
+# last one applied. Add new steps to the end of SCHEMA_MIGRATIONS rather
+# than editing earlier ones.
+_MIGRATION_LOCK_KEY = 72431006
+
+def _migrate_baseline(conn, postgres):
+    # Everything init_db used to create ad hoc; idempotent so databases that
+    # predate schema_version pass through it unchanged.
+    for stmt in _baseline_statements(postgres):
+        conn.execute(text(stmt))
+    _ensure_column(conn, "ingestion_state", "history_complete", "INTEGER DEFAULT 0")
+    for column in ("last_price_refresh", "top_coins_snapshot"):
+        _ensure_column(conn, "meta_info", column, "TEXT")
+    _ensure_column(conn, "meta_info", "schema_version", "INTEGER DEFAULT 0")
+    for column, ddl in (
+        ("repair_sec", "REAL"), ("gaps_found", "INTEGER"), ("gaps_filled", "INTEGER"),
+        ("stage", "TEXT"), ("snapshot_id", "TEXT"), ("attempts", "INTEGER DEFAULT 1")
+    ):
+        _ensure_column(conn, "pipeline_runs", column, ddl)
+    _bootstrap_ingestion_state(conn)
+
+def _migrate_lookup_columns(conn, postgres):
+    # day: UTC day number of the candle, so range reads compare integers
+    # instead of TEXT dates. symbol_key: UPPER(symbol), indexed, replacing
+    # UPPER(symbol) = :symbol scans. Both are generated by the database, so
+    # writers do not change.
+    if postgres:
+        generated = "STORED"
+        day_expr = f"(timestamp / {DAY_MS})::integer"
+    else:
+        generated = "VIRTUAL"
+        day_expr = f"timestamp / {DAY_MS}"
+    _ensure_column(conn, "ohlcv_data", "day", f"INTEGER GENERATED ALWAYS AS ({day_expr}) {generated}")
+    _ensure_column(conn, "top_coins", "symbol_key", f"TEXT GENERATED ALWAYS AS (UPPER(symbol)) {generated}")
+
+    if postgres:
+        # Chart/indicator/LSTM reads are answered from the index alone.
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_ohlcv_symbol_day
+            ON ohlcv_data (symbol, day) INCLUDE (date, open, high, low, close, volume)
+        """))
+    else:
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_ohlcv_symbol_day
+            ON ohlcv_data (symbol, day, date, open, high, low, close, volume)
+        """))
+    # UNIQUE(symbol, timestamp) already provides this index.
+    conn.execute(text("DROP INDEX IF EXISTS idx_st"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_top_coins_symbol_key ON top_coins(symbol_key, market_cap_rank)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS idx_top_coins_rank ON top_coins(market_cap_rank)"))
+
+def _migrate_storage_maintenance(conn, postgres):
+    # Day of the last maintain_ohlcv_storage pass, so workers starting the
+    # same day skip it.
+    _ensure_column(conn, "meta_info", "ohlcv_maintained_on", "TEXT")
+
+SCHEMA_MIGRATIONS = [
+    (1, "baseline tables", _migrate_baseline),
+    (2, "integer day and symbol_key lookup columns with covering indexes", _migrate_lookup_columns),
+    (3, "ohlcv storage maintenance marker", _migrate_storage_maintenance),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def _schema_version(conn):
+    inspector = inspect(conn)
+    if not inspector.has_table("meta_info"):
+        return 0
+    if "schema_version" not in {c["name"] for c in inspector.get_columns("meta_info")}:
+        return 0
+    return conn.execute(text("SELECT schema_version FROM meta_info WHERE id = 1")).scalar() or 0
+
+def _target_ohlcv_layout():
+    layout = OHLCV_PARTITIONING if is_postgres() else ""
+    if layout not in OHLCV_LAYOUTS:
+        raise ValueError(f"OHLCV_PARTITIONING must be one of {OHLCV_LAYOUTS[1:]}, got {OHLCV_PARTITIONING!r}")
+    return layout
+
+def check_schema():
+    """Raise if the database is behind SCHEMA_VERSION; never migrates, so it is cheap enough for web workers"""
+    with get_db_engine().connect() as conn:
+        version = _schema_version(conn)
+    if version < SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, this code needs {SCHEMA_VERSION}; "
+            "run `python crypto.py migrate` first"
+        )
+
+def init_db(convert_layout=False):
+    """Bring the schema up to SCHEMA_VERSION and, with convert_layout, ohlcv_data to the OHLCV_PARTITIONING layout
 
+    Migrations can rewrite ohlcv_data, so this runs as its own step
+    (`python crypto.py migrate`) rather than from web or pipeline processes,
+    which only call check_schema(). Converting a populated ohlcv_data copies
+    every candle in one transaction, so it is left to the one-time offline
+    `python crypto.py partition`; an empty table is converted right away.
+    """
+    engine = get_db_engine()
+    postgres = is_postgres()
+    layout = _target_ohlcv_layout()
+
+    with engine.connect() as conn:
+        current = _schema_version(conn) >= SCHEMA_VERSION and (not layout or _ohlcv_layout(conn) == layout)
+
+    if not current:
+        with engine.connect() as conn:
+            # Serialize concurrent workers: a transaction-scoped advisory lock
+            # (safe behind pgbouncer) or SQLite's write lock taken up front.
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _MIGRATION_LOCK_KEY})
+            else:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            version = _schema_version(conn)
+            for number, description, migrate in SCHEMA_MIGRATIONS:
+                if number <= version:
+                    continue
+                print(f"Applying schema migration {number}: {description}")
+                migrate(conn, postgres)
+                conn.execute(text("UPDATE meta_info SET schema_version = :version WHERE id = 1"), {"version": number})
+            if layout and _ohlcv_layout(conn) != layout:
+                if convert_layout or not conn.execute(text("SELECT 1 FROM ohlcv_data LIMIT 1")).first():
+                    _partition_ohlcv_data(conn, layout)
+                else:
+                    print(
+                        f"OHLCV_PARTITIONING={layout} but ohlcv_data is not partitioned that way yet. "
+                        "Converting it is a one-time offline operation: stop the web service and the "
+                        "scheduler, then run `python crypto.py partition`"
+                    )
+            conn.commit()
+
+    if postgres or OHLCV_RETENTION_YEARS > 0:
+        try:
+            maintain_ohlcv_storage()
+        except Exception as e:
+            print(f"OHLCV storage maintenance failed: {e}")
+
+
+# OHLCV STORAGE (Postgres partitioning, retention)
+OHLCV_LAYOUTS = ("", "year", "symbol")
+# Binance's first daily candles are from 2017; year partitions start there.
+OHLCV_FIRST_YEAR = 2017
+
+def _ohlcv_layout(conn):
+    """How ohlcv_data is partitioned on Postgres: "year", "symbol" or "" for a plain table"""
+    strategy = conn.execute(text("""
+        SELECT pt.partstrat
+        FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = 'ohlcv_data' AND pg_table_is_visible(c.oid)
+    """)).scalar()
+    return {"r": "year", "h": "symbol"}.get(strategy, "")
+
+def _year_partitions(conn):
+    rows = conn.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'ohlcv_data' AND pg_table_is_visible(p.oid)
+    """)).scalars().all()
+    return sorted(int(name[len("ohlcv_data_y"):]) for name in rows if name.startswith("ohlcv_data_y"))
+
+def _create_year_partition(conn, year):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS ohlcv_data_y{year} PARTITION OF ohlcv_data "
+        f"FOR VALUES FROM ({_year_start_ms(year)}) TO ({_year_start_ms(year + 1)})"
+    ))
+
+def _partition_ohlcv_data(conn, layout):
+    """Rebuild ohlcv_data as a table partitioned by `layout` and move the existing candles into it"""
+    # Holds ACCESS EXCLUSIVE on ohlcv_data until the caller commits; only
+    # `python crypto.py partition` runs this against a populated table.
+    started = time.time()
+    print(f"Partitioning ohlcv_data by {layout}; readers and writers block until the copy commits")
+    conn.execute(text("ALTER TABLE ohlcv_data RENAME TO ohlcv_data_unpartitioned"))
+    # Index and constraint names are schema-wide; free them for the new table.
+    for index in ("idx_ohlcv_symbol_day", "idx_ohlcv_ts_brin", "idx_st"):
+        conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+    for constraint in ("ohlcv_data_pkey", "ohlcv_data_symbol_timestamp_key"):
+        conn.execute(text(f"ALTER TABLE ohlcv_data_unpartitioned DROP CONSTRAINT IF EXISTS {constraint}"))
+
+    # No surrogate id: a partitioned table's keys must include the partition
+    # key, and nothing reads ohlcv_data.id.
+    partition_by = "RANGE (timestamp)" if layout == "year" else "HASH (symbol)"
+    conn.execute(text(f"""
+        CREATE TABLE ohlcv_data (
+            symbol TEXT,
+            timestamp BIGINT,
+            date TEXT,
+            open DOUBLE PRECISION,
+            high DOUBLE PRECISION,
+            low DOUBLE PRECISION,
+            close DOUBLE PRECISION,
+            volume DOUBLE PRECISION,
+            day INTEGER GENERATED ALWAYS AS ((timestamp / {DAY_MS})::integer) STORED,
+            UNIQUE(symbol, timestamp)
+        ) PARTITION BY {partition_by}
+    """))
+
+    if layout == "year":
+        first_ts = conn.execute(text("SELECT MIN(timestamp) FROM ohlcv_data_unpartitioned")).scalar()
+        first_year = OHLCV_FIRST_YEAR
+        if first_ts is not None:
+            first_year = min(first_year, dt.datetime.fromtimestamp(first_ts / 1000, dt.timezone.utc).year)
+        for year in range(first_year, dt.datetime.now(dt.timezone.utc).year + 2):
+            _create_year_partition(conn, year)
+        # Catches candles outside every year range instead of failing the insert.
+        conn.execute(text("CREATE TABLE ohlcv_data_default PARTITION OF ohlcv_data DEFAULT"))
+    else:
+        for remainder in range(OHLCV_HASH_PARTITIONS):
+            conn.execute(text(
+                f"CREATE TABLE ohlcv_data_h{remainder:02d} PARTITION OF ohlcv_data "
+                f"FOR VALUES WITH (MODULUS {OHLCV_HASH_PARTITIONS}, REMAINDER {remainder})"
+            ))
+
+    # Copied in time order so the BRIN ranges below start out tight.
+    columns = ", ".join(CANDLE_COLUMNS)
+    moved = conn.execute(text(f"""
+        INSERT INTO ohlcv_data ({columns})
+        SELECT {columns} FROM ohlcv_data_unpartitioned
+        ORDER BY timestamp
+    """)).rowcount
+    conn.execute(text("DROP TABLE ohlcv_data_unpartitioned"))
+
+    conn.execute(text("""
+        CREATE INDEX idx_ohlcv_symbol_day
+        ON ohlcv_data (symbol, day) INCLUDE (date, open, high, low, close, volume)
+    """))
+    # Candles arrive roughly in time order within each partition, so a BRIN
+    # index answers timestamp-range scans (retention, exports) for a few
+    # pages instead of a second full B-tree.
+    conn.execute(text(
+        "CREATE INDEX idx_ohlcv_ts_brin ON ohlcv_data USING BRIN (timestamp) WITH (pages_per_range = 32)"
+    ))
+    print(f"Moved {moved} candles into the partitioned ohlcv_data in {time.time() - started:.1f}s")
+
+_ARCHIVE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS ohlcv_archive (
+        symbol TEXT,
+        timestamp BIGINT,
+        date TEXT,
+        open DOUBLE PRECISION,
+        high DOUBLE PRECISION,
+        low DOUBLE PRECISION,
+        close DOUBLE PRECISION,
+        volume DOUBLE PRECISION,
+        UNIQUE(symbol, timestamp)
+    )
+"""
+
+def _expire_candles(conn, cutoff_ms):
+    """Archive or drop candles older than cutoff_ms; returns how many left ohlcv_data"""
+    params = {"cutoff": cutoff_ms}
+    if OHLCV_RETENTION_MODE == "archive":
+        columns = ", ".join(CANDLE_COLUMNS)
+        conn.execute(text(_ARCHIVE_TABLE_SQL))
+        conn.execute(text(f"""
+            INSERT INTO ohlcv_archive ({columns})
+            SELECT {columns} FROM ohlcv_data WHERE timestamp < :cutoff
+            ON CONFLICT (symbol, timestamp) DO NOTHING
+        """), params)
+    expired = conn.execute(text("DELETE FROM ohlcv_data WHERE timestamp < :cutoff"), params).rowcount
+    conn.execute(text("DELETE FROM ohlcv_known_gaps WHERE end_ts < :cutoff"), params)
+    return max(expired or 0, 0)
+
+def _refresh_expired_ingestion_state(conn, cutoff_ms):
+    # Pairs whose oldest candle expired get their watermarks recomputed from
+    # what is left; a pair with nothing left reads as cold again.
+    conn.execute(text("""
+        UPDATE ingestion_state SET
+            first_ts = (SELECT MIN(d.timestamp) FROM ohlcv_data d WHERE d.symbol = ingestion_state.symbol),
+            last_ts = (SELECT MAX(d.timestamp) FROM ohlcv_data d WHERE d.symbol = ingestion_state.symbol),
+            row_count = (SELECT COUNT(*) FROM ohlcv_data d WHERE d.symbol = ingestion_state.symbol)
+        WHERE first_ts < :cutoff
+    """), {"cutoff": cutoff_ms})
+
+def _maintain_ohlcv_storage():
+    stats = {"partitions_created": 0, "partitions_expired": 0, "candles_expired": 0}
+    cutoff_ms = ohlcv_retention_cutoff_ms()
     engine = get_db_engine()
     with engine.begin() as conn:
-        for stmt in statements:
-            conn.execute(text(stmt))
+        if is_postgres() and _ohlcv_layout(conn) == "year":
+            existing = _year_partitions(conn)
+            this_year = dt.datetime.now(dt.timezone.utc).year
+            for year in (this_year, this_year + 1):
+                if year not in existing:
+                    _create_year_partition(conn, year)
+                    stats["partitions_created"] += 1
+            # Whole expired years leave as a metadata operation instead of a DELETE.
+            for year in existing:
+                if not cutoff_ms or _year_start_ms(year + 1) > cutoff_ms:
+                    continue
+                conn.execute(text(f"ALTER TABLE ohlcv_data DETACH PARTITION ohlcv_data_y{year}"))
+                if OHLCV_RETENTION_MODE == "archive":
+                    conn.execute(text(f"ALTER TABLE ohlcv_data_y{year} RENAME TO ohlcv_archive_y{year}"))
+                else:
+                    conn.execute(text(f"DROP TABLE ohlcv_data_y{year}"))
+                stats["partitions_expired"] += 1
+
+        if cutoff_ms:
+            stats["candles_expired"] = _expire_candles(conn, cutoff_ms)
+            _refresh_expired_ingestion_state(conn, cutoff_ms)
+    return stats
+
+def maintain_ohlcv_storage(force=False):
+    """Create upcoming year partitions and apply OHLCV_RETENTION_YEARS, at most once a day"""
+    if OHLCV_RETENTION_MODE not in ("archive", "drop"):
+        raise ValueError(f"OHLCV_RETENTION_MODE must be 'archive' or 'drop', got {OHLCV_RETENTION_MODE!r}")
+    today = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d")
+    with read_your_writes():
+        maintained_on = fetch_scalar("SELECT ohlcv_maintained_on FROM meta_info WHERE id = 1")
+    if not force and maintained_on == today:
+        return None
+    with db_lock("ohlcv-maintenance", PIPELINE_LOCK_TTL_SEC) as acquired:
+        if not acquired:
+            return None
+        stats = _maintain_ohlcv_storage()
+        execute_write("UPDATE meta_info SET ohlcv_maintained_on = :today WHERE id = 1", {"today": today})
+    if any(stats.values()):
+        print(f"OHLCV storage maintenance: {stats}")
+    return stats
 
 
 
@@ -308,46 +1718,41 @@ def filter_1_fetch_top_coins():
 
     page_count = int(os.getenv("COINGECKO_PAGE_COUNT", "4"))
     per_page = int(os.getenv("COINGECKO_PER_PAGE", "250"))
+    max_coins = int(os.getenv("COINGECKO_MAX_COINS", str(page_count * per_page)))
     base_delay = float(os.getenv("COINGECKO_PAGE_DELAY_SEC", "1.2"))
     max_retries = int(os.getenv("COINGECKO_MAX_RETRIES", "5"))
 
     def fetch(p):
         url = f"{COINGECKO_BASE}/api/v3/coins/markets"
-        for attempt in range(max_retries):
-            try:
-                r = requests.get(
-                    url,
-                    params={
-                        "vs_currency": "usd",
-                        "order": "market_cap_desc",
-                        "per_page": per_page,
-                        "page": p
-                    },
-                    headers=HEADERS,
-                    timeout=15
-                )
-                if r.status_code == 200:
-                    return r.json()
-                if r.status_code == 429:
-                    retry_after = r.headers.get("Retry-After")
-                    wait = float(retry_after) if retry_after else (base_delay * (2 ** attempt))
-                    print(f"Coingecko rate limit hit; waiting {wait:.1f}s before retry")
-                    time.sleep(wait)
-                    continue
-                print(f"Coingecko error: status={r.status_code} body={r.text[:200]}")
-                return []
-            except Exception:
-                print("Coingecko error: request failed")
-                time.sleep(base_delay * (2 ** attempt))
+        try:
+            r = http_get(
+                url,
+                params={
+                    "vs_currency": "usd",
+                    "order": "market_cap_desc",
+                    "per_page": per_page,
+                    "page": p
+                },
+                headers=HEADERS,
+                timeout=15,
+                max_retries=max_retries,
+                backoff_base=base_delay
+            )
+        except Exception:
+            print("Coingecko error: request failed")
+            return []
+        if r.status_code == 200:
+            return r.json()
+        print(f"Coingecko error: status={r.status_code} body={r.text[:200]}")
         return []
 
     raw = []
-    for p in range(1, page_count + 1):
-        batch = fetch(p)
-        if not batch:
-            continue
-        raw.extend(batch)
-        time.sleep(base_delay)
+    workers = max(min(COINGECKO_CONCURRENCY, page_count), 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for batch in ex.map(fetch, range(1, page_count + 1)):
+            if not batch:
+                continue
+            raw.extend(batch)
 
     valid = []
     for c in raw:
@@ -371,7 +1776,7 @@ def filter_1_fetch_top_coins():
                 "liquidity_score": c["total_volume"] / c["market_cap"]
             })
 
-            if len(valid) >= 1000:
+            if len(valid) >= max_coins:
                 break
 
     print(f"Validni: {len(valid)}/{len(raw)}")
@@ -380,38 +1785,236 @@ def filter_1_fetch_top_coins():
 
 
 # Fetch Binance symbols
-def get_binance_symbols():
-    global _ACTIVE_BINANCE_BASE
+def _fetch_binance_symbols():
     for base in BINANCE_BASES:
         url = base + "/api/v3/exchangeInfo"
-        for attempt in range(3):
-            try:
-                r = requests.get(url, timeout=10)
-                if r.status_code == 451:
-                    print(f"Binance exchangeInfo restricted on {base} (451)")
-                    break
-                if r.status_code != 200:
-                    print(f"Binance exchangeInfo error ({base}): status={r.status_code} body={r.text[:200]}")
-                    time.sleep(1.0 * (2 ** attempt))
-                    continue
-                payload = r.json()
-                symbols = payload.get("symbols", [])
-                if not symbols:
-                    print(f"Binance exchangeInfo error ({base}): no symbols in response")
-                    break
-                _ACTIVE_BINANCE_BASE = base
-                return {
-                    s["symbol"]
-                    for s in symbols
-                    if s.get("status") == "TRADING" and s.get("symbol", "").endswith("USDT")
-                }
-            except Exception:
-                time.sleep(1.0 * (2 ** attempt))
-                continue
-    return set()
+        try:
+            r = http_get(url, timeout=10, cost=EXCHANGE_INFO_WEIGHT, max_retries=2)
+        except Exception:
+            print(f"Binance exchangeInfo error ({base}): request failed")
+            continue
+        if r.status_code == 451:
+            print(f"Binance exchangeInfo restricted on {base} (451)")
+            continue
+        if r.status_code != 200:
+            print(f"Binance exchangeInfo error ({base}): status={r.status_code} body={r.text[:200]}")
+            continue
+        symbols = r.json().get("symbols", [])
+        if not symbols:
+            print(f"Binance exchangeInfo error ({base}): no symbols in response")
+            continue
+        return base, {
+            s["symbol"]
+            for s in symbols
+            if s.get("status") == "TRADING" and s.get("symbol", "").endswith("USDT")
+        }
+    return None, set()
+
+
+def _set_binance_symbols_cache(base, symbols, fetched_at):
+    global _ACTIVE_BINANCE_BASE
+    _BINANCE_SYMBOLS_CACHE.update(symbols=symbols, base=base, fetched_at=fetched_at)
+    _ACTIVE_BINANCE_BASE = base
+
+
+def _load_persisted_binance_symbols():
+    try:
+        row = fetch_mapping("SELECT base, symbols, fetched_at FROM binance_symbols WHERE id = 1")
+    except Exception as e:
+        print(f"Could not load cached Binance symbols: {e}")
+        return
+    if row and row["symbols"] and row["base"] in BINANCE_BASES:
+        _set_binance_symbols_cache(row["base"], set(row["symbols"].split(",")), float(row["fetched_at"]))
+
+
+def refresh_binance_symbols():
+    base, symbols = _fetch_binance_symbols()
+    if not symbols:
+        return _BINANCE_SYMBOLS_CACHE["symbols"] or set()
+
+    fetched_at = time.time()
+    with _BINANCE_SYMBOLS_LOCK:
+        _set_binance_symbols_cache(base, symbols, fetched_at)
+    try:
+        execute_write("""
+            INSERT INTO binance_symbols (id, base, symbols, fetched_at)
+            VALUES (1, :base, :symbols, :fetched_at)
+            ON CONFLICT (id) DO UPDATE SET
+                base = EXCLUDED.base,
+                symbols = EXCLUDED.symbols,
+                fetched_at = EXCLUDED.fetched_at
+        """, {"base": base, "symbols": ",".join(sorted(symbols)), "fetched_at": fetched_at})
+    except Exception as e:
+        print(f"Could not persist Binance symbols: {e}")
+    return symbols
+
+
+def _refresh_binance_symbols_in_background():
+    if _BINANCE_SYMBOLS_REFRESHING.is_set():
+        return
+    _BINANCE_SYMBOLS_REFRESHING.set()
+
+    def run():
+        try:
+            refresh_binance_symbols()
+        finally:
+            _BINANCE_SYMBOLS_REFRESHING.clear()
+
+    threading.Thread(target=run, name="binance-symbols-refresh", daemon=True).start()
+
+
+def get_binance_symbols(force_refresh=False):
+    if not force_refresh:
+        if _BINANCE_SYMBOLS_CACHE["symbols"] is None:
+            with _BINANCE_SYMBOLS_LOCK:
+                if _BINANCE_SYMBOLS_CACHE["symbols"] is None:
+                    _load_persisted_binance_symbols()
+
+        symbols = _BINANCE_SYMBOLS_CACHE["symbols"]
+        if symbols:
+            if time.time() - _BINANCE_SYMBOLS_CACHE["fetched_at"] >= BINANCE_SYMBOLS_TTL_SEC:
+                _refresh_binance_symbols_in_background()
+            return symbols
+
+    return refresh_binance_symbols()
 
 
 
+TOP_COINS_COLUMNS = (
+    "coin_id", "symbol", "name", "market_cap_rank",
+    "price", "market_cap", "volume_24h", "liquidity_score"
+)
+
+def replace_top_coins(rows):
+    """Swap in a new top_coins set in one transaction; returns (rows changed, rows removed)"""
+    columns = ", ".join(TOP_COINS_COLUMNS)
+    updates = ",\n".join(f"{c} = EXCLUDED.{c}" for c in TOP_COINS_COLUMNS[1:])
+    distinct_op = "IS DISTINCT FROM" if is_postgres() else "IS NOT"
+    changed_predicate = " OR ".join(
+        f"top_coins.{c} {distinct_op} EXCLUDED.{c}" for c in TOP_COINS_COLUMNS[1:]
+    )
+
+    engine = get_db_engine()
+    # Readers keep seeing the previous snapshot until this commits (MVCC on
+    # Postgres, WAL on SQLite), and rows that did not change are not rewritten.
+    with engine.begin() as conn:
+        if is_postgres():
+            conn.execute(text(f"""
+                CREATE TEMP TABLE _top_coins_stage ON COMMIT DROP AS
+                SELECT {columns} FROM top_coins WITH NO DATA
+            """))
+        else:
+            conn.execute(text("DROP TABLE IF EXISTS temp._top_coins_stage"))
+            conn.execute(text(f"CREATE TEMP TABLE _top_coins_stage AS SELECT {columns} FROM top_coins WHERE 0"))
+
+        conn.execute(text(f"""
+            INSERT INTO _top_coins_stage ({columns})
+            VALUES ({", ".join(":" + c for c in TOP_COINS_COLUMNS)})
+        """), rows)
+
+        removed = conn.execute(text("""
+            DELETE FROM top_coins
+            WHERE coin_id NOT IN (SELECT coin_id FROM _top_coins_stage)
+        """)).rowcount
+        changed = conn.execute(text(f"""
+            INSERT INTO top_coins ({columns})
+            SELECT {columns} FROM _top_coins_stage WHERE true
+            ON CONFLICT (coin_id) DO UPDATE SET
+                {updates}
+            WHERE {changed_predicate}
+        """)).rowcount
+
+        # Checkpointed pipeline runs only resume against the snapshot they started from.
+        conn.execute(
+            text("UPDATE meta_info SET top_coins_snapshot = :snapshot WHERE id = 1"),
+            {"snapshot": uuid.uuid4().hex}
+        )
+
+        if not is_postgres():
+            conn.execute(text("DROP TABLE temp._top_coins_stage"))
+
+    return changed, removed
+
+
+def fetch_binance_usdt_tickers(base=None):
+    """{BASE_SYMBOL: (last price, 24h quote volume)} for every USDT pair in one request"""
+    base = (base or _ACTIVE_BINANCE_BASE).rstrip("/")
+    r = http_get(base + "/api/v3/ticker/24hr", timeout=15, cost=TICKER_24HR_WEIGHT)
+    if r.status_code != 200:
+        print(f"Binance ticker error ({base}): status={r.status_code} body={r.text[:200]}")
+        return {}
+    tickers = {}
+    for t in r.json():
+        pair = t.get("symbol", "")
+        if not pair.endswith("USDT") or len(pair) <= 4:
+            continue
+        try:
+            tickers[pair[:-4]] = (float(t["lastPrice"]), float(t.get("quoteVolume") or 0))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return tickers
+
+def update_top_coin_prices(prices, refreshed_at=None):
+    """Set price/volume_24h for every listed symbol in one UPDATE; prices maps SYMBOL -> (price, volume)"""
+    if not prices:
+        return 0
+    distinct_op = "IS DISTINCT FROM" if is_postgres() else "IS NOT"
+    refreshed_at = refreshed_at or dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        if is_postgres():
+            conn.execute(text("""
+                CREATE TEMP TABLE _price_stage (
+                    symbol TEXT PRIMARY KEY,
+                    price DOUBLE PRECISION,
+                    volume_24h DOUBLE PRECISION
+                ) ON COMMIT DROP
+            """))
+        else:
+            conn.execute(text("DROP TABLE IF EXISTS temp._price_stage"))
+            conn.execute(text("CREATE TEMP TABLE _price_stage (symbol TEXT PRIMARY KEY, price REAL, volume_24h REAL)"))
+
+        conn.execute(text("""
+            INSERT INTO _price_stage (symbol, price, volume_24h)
+            VALUES (:symbol, :price, :volume_24h)
+        """), [
+            {"symbol": symbol, "price": price, "volume_24h": volume}
+            for symbol, (price, volume) in prices.items()
+        ])
+        updated = conn.execute(text(f"""
+            UPDATE top_coins
+            SET price = s.price, volume_24h = s.volume_24h
+            FROM _price_stage s
+            WHERE top_coins.symbol_key = s.symbol
+              AND (top_coins.price {distinct_op} s.price OR top_coins.volume_24h {distinct_op} s.volume_24h)
+        """)).rowcount
+        conn.execute(
+            text("UPDATE meta_info SET last_price_refresh = :refreshed_at WHERE id = 1"),
+            {"refreshed_at": refreshed_at}
+        )
+
+        if not is_postgres():
+            conn.execute(text("DROP TABLE temp._price_stage"))
+
+    return updated
+
+def refresh_top_coin_prices(min_interval_sec=None, prices=None):
+    """Update top_coins from the bulk ticker (or given prices) unless another process refreshed recently"""
+    min_interval_sec = PRICE_REFRESH_SEC if min_interval_sec is None else min_interval_sec
+    with db_lock("price-refresh", max(min_interval_sec, 30)) as acquired:
+        if not acquired:
+            return 0
+        with read_your_writes():
+            last = fetch_scalar("SELECT last_price_refresh FROM meta_info WHERE id = 1")
+        if last and min_interval_sec:
+            age = dt.datetime.now(dt.timezone.utc) - dt.datetime.strptime(last, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=dt.timezone.utc)
+            # Small slack so refreshers on the same cadence do not skip a beat.
+            if age.total_seconds() < min_interval_sec * 0.9:
+                return 0
+        return update_top_coin_prices(fetch_binance_usdt_tickers() if prices is None else prices)
+
+
 # FILTER 2 — Use Cached Top1000 OR Update if Needed
 def filter_2_check_last_dates(coins):
     print("FILTER 2: Load or Update Top1000")
@@ -419,14 +2022,13 @@ def filter_2_check_last_dates(coins):
     if should_update_top1000():
         print("Updating Top1000 for today")
 
-        if not coins:
+        fetched = bool(coins)
+        if not fetched:
             print("No coins fetched; keeping existing cache")
             rows = fetch_mappings("SELECT * FROM top_coins")
             coins = rows
             # continue to source selection below
 
-        execute_write("DELETE FROM top_coins")
-
         required_keys = {
             "coin_id", "symbol", "name", "market_cap_rank",
             "price", "market_cap", "volume_24h", "liquidity_score"
@@ -450,20 +2052,9 @@ def filter_2_check_last_dates(coins):
                     "liquidity_score": x["liquidity_score"]
                 })
 
-        if insert_rows:
-            execute_many("""
-                INSERT INTO top_coins
-                (coin_id, symbol, name, market_cap_rank, price, market_cap, volume_24h, liquidity_score)
-                VALUES (:coin_id, :symbol, :name, :market_cap_rank, :price, :market_cap, :volume_24h, :liquidity_score)
-                ON CONFLICT (coin_id) DO UPDATE SET
-                    symbol = EXCLUDED.symbol,
-                    name = EXCLUDED.name,
-                    market_cap_rank = EXCLUDED.market_cap_rank,
-                    price = EXCLUDED.price,
-                    market_cap = EXCLUDED.market_cap,
-                    volume_24h = EXCLUDED.volume_24h,
-                    liquidity_score = EXCLUDED.liquidity_score
-            """, insert_rows)
+        if fetched and insert_rows:
+            changed, removed = replace_top_coins(insert_rows)
+            print(f"Top1000 rows changed: {changed}, removed: {removed}")
 
         mark_top1000_updated()
         print("Top1000 updated")
@@ -474,25 +2065,31 @@ def filter_2_check_last_dates(coins):
         rows = fetch_mappings("SELECT * FROM top_coins")
         coins = rows
 
+    return _match_binance_pairs(coins)
+
+def _match_binance_pairs(coins):
+    """Coins tradable as USDT pairs on Binance, annotated with their ingestion state"""
     binance = get_binance_symbols()
     if not binance:
         print("Binance symbols unavailable on all configured hosts")
         return []
 
+    states = load_ingestion_states()
+
     result = []
     for coin in coins:
         pair = coin["symbol"] + "USDT"
         if pair not in binance:
             continue
 
-        last_ts = fetch_scalar(
-            "SELECT MAX(timestamp) FROM ohlcv_data WHERE symbol = :symbol",
-            {"symbol": pair}
-        )
+        state = states.get(pair)
+        last_ts = state["last_ts"] if state else None
 
         coin["binance_pair"] = pair
         coin["binance_base"] = _ACTIVE_BINANCE_BASE
         coin["last_timestamp"] = last_ts
+        coin["last_checked_at"] = state["last_checked_at"] if state else None
+        coin["last_error"] = state["last_error"] if state else None
 
         result.append(coin)
 
@@ -505,82 +2102,339 @@ def filter_2_check_last_dates(coins):
 
 # GET LAST SAVED TIMESTAMP FOR SYMBOL
 def get_last_saved_timestamp(symbol):
-    row = fetch_scalar(
-        "SELECT MAX(timestamp) FROM ohlcv_data WHERE symbol = :symbol",
-        {"symbol": symbol}
-    )
+    state = get_ingestion_state(symbol)
 
-    if row:
-        return int(row) + 86400000
+    if state and state["last_ts"]:
+        return int(state["last_ts"]) + 86400000
 
     # Full history backfill from earliest available Binance candle.
     return 0
 
 
 # FILTER 3 — Smart OHLCV Fetch
-def filter_3_fill_missing_data(coins):
+def filter_3_fill_missing_data(coins, on_pairs_done=None):
     print("FILTER 3: Smart OHLCV Fetch")
 
     def download(coin):
         pair = coin["binance_pair"]
         base = coin.get("binance_base") or _ACTIVE_BINANCE_BASE
+        started = time.perf_counter()
+
+        def result(saved, error=None):
+            outcome = {
+                "symbol": pair,
+                "candles": saved,
+                "seconds": time.perf_counter() - started,
+                "error": str(error) if error else None
+            }
+            if on_pairs_done:
+                try:
+                    on_pairs_done([outcome])
+                except Exception as e:
+                    print(f"Could not checkpoint {pair}: {e}")
+            return outcome
 
         try:
             start = get_last_saved_timestamp(pair)
             end = int(time.time() * 1000)
 
             if start >= end:
-                return (pair, 0)
+                return result(0)
 
-            candles = _fetch_binance_candles(pair, start, end, binance_base=base)
-            if candles is None:
-                # Binance request failed for this pair; continue pipeline.
-                return (pair, 0)
+            saved, error = stream_candles_to_db(pair, start, end, binance_base=base)
+            if error is not None:
+                # Binance request failed for this pair; pages already written stay.
+                print(f"OHLCV fetch failed for {pair}: {error}")
+                record_ingestion_checks([(pair, error)])
+                return result(saved, error)
 
-            if candles:
-                _save_candles(candles)
+            record_ingestion_checks([(pair, None)])
+            if start == 0 and saved:
+                mark_history_complete([pair])
 
-            return (pair, len(candles))
+            return result(saved)
         except Exception as e:
             print(f"OHLCV fetch failed for {pair}: {e}")
-            return (pair, 0)
+            record_ingestion_checks([(pair, e)])
+            return result(0, e)
+
+    results = None
+    if BINANCE_INGEST_MODE == "async":
+        from async_ingest import AIOHTTP_AVAILABLE, ingest_pairs
+        if AIOHTTP_AVAILABLE:
+            results = ingest_pairs(coins, on_pairs_done=on_pairs_done)
+        else:
+            print("aiohttp not installed; falling back to threaded OHLCV fetch")
 
-    with ThreadPoolExecutor(max_workers=max(BINANCE_WORKERS, 1)) as ex:
-        results = list(ex.map(download, coins))
+    if results is None:
+        with ThreadPoolExecutor(max_workers=max(BINANCE_WORKERS, 1)) as ex:
+            results = list(ex.map(_with_caller_context(download), coins))
 
-    total = sum(r[1] for r in results)
+    total = sum(r["candles"] for r in results)
 
     print(f"Candles saved: {total}")
-    return {"total": len(coins), "candles": total}
+    return {"total": len(coins), "candles": total, "pairs": results}
+
+
+
+# PIPELINE RUN HISTORY
+_PIPELINE_RUN_COLUMNS = (
+    "status", "finished_at", "filter1_sec", "filter2_sec", "filter3_sec",
+    "repair_sec", "gaps_found", "gaps_filled",
+    "coins_fetched", "binance_pairs", "candles_added", "pairs_failed", "candles_per_sec", "error"
+)
+# Summed across the attempts of a resumed run.
+_PIPELINE_RUN_COUNTERS = (
+    "duration_sec", "http_requests", "http_retries", "http_throttled", "http_errors", "http_bytes"
+)
+
+def _start_pipeline_run(run_id, job_id):
+    if BINANCE_INGEST_MODE == "async":
+        from async_ingest import BINANCE_ASYNC_CONCURRENCY as concurrency
+    else:
+        concurrency = BINANCE_WORKERS
+    execute_write("""
+        INSERT INTO pipeline_runs (id, job_id, status, started_at, ingest_mode, concurrency, stage, attempts)
+        VALUES (:id, :job_id, 'running', :started_at, :ingest_mode, :concurrency, 'filter1', 1)
+    """, {
+        "id": run_id,
+        "job_id": job_id,
+        "started_at": int(time.time() * 1000),
+        "ingest_mode": BINANCE_INGEST_MODE,
+        "concurrency": concurrency
+    })
+
+def _checkpoint_pipeline_run(run_id, stage, values=None):
+    values = dict(values or {})
+    assignments = ", ".join(f"{column} = :{column}" for column in values)
+    values.update({"id": run_id, "stage": stage})
+    execute_write(
+        f"UPDATE pipeline_runs SET stage = :stage{', ' + assignments if assignments else ''} WHERE id = :id",
+        values
+    )
+
+def _record_run_pairs(run_id, results):
+    if results:
+        execute_many("""
+            INSERT INTO pipeline_run_pairs (run_id, symbol, candles, seconds, error)
+            VALUES (:run_id, :symbol, :candles, :seconds, :error)
+        """, [{"run_id": run_id, **result} for result in results])
+
+def _finish_pipeline_run(run_id, values):
+    columns = [c for c in _PIPELINE_RUN_COLUMNS if c in values]
+    assignments = [f"{c} = :{c}" for c in columns]
+    assignments += [f"{c} = COALESCE({c}, 0) + :{c}" for c in _PIPELINE_RUN_COUNTERS]
+    params = {c: values.get(c) for c in columns}
+    params.update({c: values.get(c) or 0 for c in _PIPELINE_RUN_COUNTERS})
+    params["id"] = run_id
+    execute_write(f"UPDATE pipeline_runs SET {', '.join(assignments)} WHERE id = :id", params)
+
+def _find_resumable_run(snapshot_id):
+    """Latest interrupted run that stopped in filter 3 or later on the same top_coins snapshot and day"""
+    # Only called under the pipeline lock, so any 'running' row is orphaned.
+    rows = fetch_mappings("SELECT * FROM pipeline_runs WHERE status = 'running' ORDER BY started_at DESC")
+    if not rows:
+        return None
+    run, stale = rows[0], rows[1:]
+    cutoff = int(time.time() * 1000) - PIPELINE_RESUME_MAX_AGE_SEC * 1000
+    resumable = (
+        run["stage"] in ("filter3", "repair")
+        and snapshot_id is not None
+        and run["snapshot_id"] == snapshot_id
+        and (run["started_at"] or 0) >= cutoff
+        # A run interrupted before midnight would skip today's Coingecko
+        # refresh; start over instead.
+        and not should_update_top1000()
+    )
+    if not resumable:
+        stale.append(run)
+        run = None
+    if stale:
+        execute_many(
+            "UPDATE pipeline_runs SET status = 'interrupted' WHERE id = :id",
+            [{"id": r["id"]} for r in stale]
+        )
+    return run
 
+def list_pipeline_runs(limit=20):
+    return fetch_mappings(
+        "SELECT * FROM pipeline_runs ORDER BY started_at DESC LIMIT :limit",
+        {"limit": limit}
+    )
+
+def get_pipeline_run(run_id, pair_limit=50, order="slowest"):
+    run = fetch_mapping("SELECT * FROM pipeline_runs WHERE id = :id", {"id": run_id})
+    if not run:
+        return None
+    order_by = {
+        "slowest": "seconds DESC",
+        "candles": "candles DESC",
+        "failed": "(error IS NULL) ASC, seconds DESC"
+    }.get(order, "seconds DESC")
+    run["pairs"] = fetch_mappings(f"""
+        SELECT symbol, candles, seconds, error
+        FROM pipeline_run_pairs
+        WHERE run_id = :run_id
+        ORDER BY {order_by}
+        LIMIT :limit
+    """, {"run_id": run_id, "limit": pair_limit})
+    return run
 
 
 # RUN PIPELINE
-def run_pipeline():
+def run_pipeline(job_id=None):
+    check_schema()
+    # Daily partition upkeep and retention ride along with the pipeline
+    # rather than web worker startup.
+    if is_postgres() or OHLCV_RETENTION_YEARS > 0:
+        try:
+            maintain_ohlcv_storage()
+        except Exception as e:
+            print(f"OHLCV storage maintenance failed: {e}")
+    with db_lock("pipeline", PIPELINE_LOCK_TTL_SEC) as acquired:
+        if not acquired:
+            print("Another pipeline run holds the lock; skipping")
+            return {"skipped": True, "reason": "Another pipeline run is in progress"}
+        # The run re-reads its own checkpoints and top_coins snapshot.
+        with read_your_writes():
+            return _run_pipeline_locked(job_id)
+
+def _run_pipeline_locked(job_id=None):
     print("SMART PIPELINE — Daily Top1000 Caching + Smart OHLCV Update")
 
+    http_before = get_http_client().stats_snapshot()
     start = time.time()
+    timings = {}
+
+    snapshot_id = fetch_scalar("SELECT top_coins_snapshot FROM meta_info WHERE id = 1")
+    resumed = _find_resumable_run(snapshot_id)
+    if resumed:
+        run_id = resumed["id"]
+        stage_name = resumed["stage"]
+        print(f"Resuming pipeline run {run_id} from {stage_name}")
+        execute_write(
+            "UPDATE pipeline_runs SET attempts = COALESCE(attempts, 1) + 1 WHERE id = :id",
+            {"id": run_id}
+        )
+    else:
+        run_id = uuid.uuid4().hex
+        stage_name = "filter1"
+        _start_pipeline_run(run_id, job_id)
+
+    def finish(values):
+        http = get_http_client().stats_snapshot()
+        values.update({
+            "finished_at": int(time.time() * 1000),
+            "duration_sec": time.time() - start,
+            "http_requests": http["requests"] - http_before["requests"],
+            "http_retries": http["retries"] - http_before["retries"],
+            "http_throttled": http["throttled"] - http_before["throttled"],
+            "http_errors": http["errors"] - http_before["errors"],
+            "http_bytes": http["bytes"] - http_before["bytes"],
+            **timings
+        })
+        try:
+            _finish_pipeline_run(run_id, values)
+        except Exception as e:
+            print(f"Could not record pipeline run {run_id}: {e}")
+
+    def checkpoint_pairs(results):
+        _record_run_pairs(run_id, results)
+
+    try:
+        if resumed:
+            # Coingecko was already fetched for this snapshot; read top_coins
+            # and the persisted Binance symbols without filter 2's daily
+            # update branch, which would mark today's refresh as done.
+            coins = []
+            coins_dates = _match_binance_pairs(fetch_mappings("SELECT * FROM top_coins"))
+            # Failed pairs are retried.
+            done = {
+                row["symbol"] for row in fetch_mappings(
+                    "SELECT symbol FROM pipeline_run_pairs WHERE run_id = :run_id AND error IS NULL",
+                    {"run_id": run_id}
+                )
+            }
+            pending = [coin for coin in coins_dates if coin["binance_pair"] not in done]
+            print(f"{len(done)} pairs already done; {len(pending)} remaining")
+        else:
+            stage = time.time()
+            coins = filter_1_fetch_top_coins()
+            timings["filter1_sec"] = time.time() - stage
+            print()
+            stage = time.time()
+            coins_dates = filter_2_check_last_dates(coins)
+            timings["filter2_sec"] = time.time() - stage
+            pending = coins_dates
+            snapshot_id = fetch_scalar("SELECT top_coins_snapshot FROM meta_info WHERE id = 1")
+            _checkpoint_pipeline_run(run_id, "filter3", {
+                "snapshot_id": snapshot_id,
+                "coins_fetched": len(coins),
+                "binance_pairs": len(coins_dates)
+            })
+            stage_name = "filter3"
+        print()
+
+        if stage_name == "filter3":
+            stage = time.time()
+            filter_3_fill_missing_data(prioritize_pairs(pending), on_pairs_done=checkpoint_pairs)
+            timings["filter3_sec"] = time.time() - stage
+            _checkpoint_pipeline_run(run_id, "repair")
+
+        repair = {}
+        if OHLCV_GAP_REPAIR:
+            print()
+            stage = time.time()
+            repair = repair_ohlcv_gaps([coin["binance_pair"] for coin in coins_dates])
+            timings["repair_sec"] = time.time() - stage
+    except Exception as e:
+        finish({"status": "failed", "error": str(e)[:1000]})
+        raise
 
-    init_db()
-    coins = filter_1_fetch_top_coins()
-    print()
-    coins_dates = filter_2_check_last_dates(coins)
-    print()
-    stats = filter_3_fill_missing_data(coins_dates)
     top_count = fetch_scalar("SELECT COUNT(*) FROM top_coins")
     print()
 
+    # Totals over every attempt of this run, not just this process; a pair
+    # retried after failing counts once, as failed only if no attempt succeeded.
+    totals = fetch_mapping("""
+        SELECT COUNT(DISTINCT symbol) AS pairs, COALESCE(SUM(candles), 0) AS candles,
+               (SELECT COUNT(DISTINCT f.symbol) FROM pipeline_run_pairs f
+                WHERE f.run_id = :run_id AND f.error IS NOT NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM pipeline_run_pairs ok
+                      WHERE ok.run_id = f.run_id AND ok.symbol = f.symbol AND ok.error IS NULL
+                  )) AS failed
+        FROM pipeline_run_pairs
+        WHERE run_id = :run_id
+    """, {"run_id": run_id})
+    filter3_sec = timings.get("filter3_sec") or 0
+    values = {
+        "status": "succeeded",
+        "candles_added": totals["candles"],
+        "pairs_failed": totals["failed"],
+        "gaps_found": repair.get("gaps_found"),
+        "gaps_filled": repair.get("gaps_filled")
+    }
+    if not resumed:
+        values["candles_per_sec"] = totals["candles"] / filter3_sec if filter3_sec > 0 else None
+    finish(values)
+    _checkpoint_pipeline_run(run_id, "done")
+
     print(f"Finished in {time.time() - start:.2f} seconds")
-    print(f"Coins processed: {stats['total']}")
-    print(f"Candles added: {stats['candles']}")
+    print(f"Coins processed: {totals['pairs']}")
+    print(f"Candles added: {totals['candles']}")
     print(f"Top coins in DB: {top_count}")
 
     return {
-        "coins_fetched": len(coins),
+        "run_id": run_id,
+        "resumed": bool(resumed),
+        "coins_fetched": len(coins) if not resumed else resumed["coins_fetched"],
         "binance_pairs": len(coins_dates),
         "top_coins": top_count or 0,
-        "coins_processed": stats["total"],
-        "candles_added": stats["candles"],
+        "coins_processed": totals["pairs"],
+        "candles_added": totals["candles"],
+        "pairs_failed": totals["failed"],
+        "gaps_filled": repair.get("gaps_filled", 0),
         "coingecko_base": COINGECKO_BASE,
         "coingecko_key_set": bool(API_KEY),
         "coingecko_key_type": API_KEY_TYPE if API_KEY else None,
@@ -588,4 +2442,13 @@ def run_pipeline():
     }
 
 if __name__ == "__main__":
-    run_pipeline()
+    # `python crypto.py migrate` only applies migrations (the deploy step);
+    # `python crypto.py partition` also converts ohlcv_data to
+    # OHLCV_PARTITIONING (offline, once); plain `python crypto.py` migrates
+    # and then runs the pipeline once.
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command not in (None, "migrate", "partition"):
+        raise SystemExit("usage: python crypto.py [migrate | partition]")
+    init_db(convert_layout=command == "partition")
+    if command is None:
+        run_pipeline()
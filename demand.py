@@ -0,0 +1,76 @@
+import os
+import threading
+from collections import Counter
+
+from sqlalchemy import func
+
+from crypto import record_pair_requests, set_pair_memberships
+from models import db, Notification, Portfolio, Watchlist
+
+# API hits are counted in memory and written once per interval, so a busy
+# chart page costs one upsert per pair per minute instead of one per request.
+DEMAND_FLUSH_SEC = float(os.getenv("DEMAND_FLUSH_SEC", "60"))
+
+_REQUEST_COUNTS = Counter()
+_REQUEST_COUNTS_LOCK = threading.Lock()
+
+
+def record_symbol_request(symbol):
+    pair = symbol.upper() + "USDT"
+    with _REQUEST_COUNTS_LOCK:
+        _REQUEST_COUNTS[pair] += 1
+
+
+def _membership_counts():
+    """(watchers, holders, alerts) per pair from the user tables"""
+    counts = {}
+    sources = (
+        (0, Watchlist, None),
+        (1, Portfolio, None),
+        (2, Notification, Notification.triggered.is_(False))
+    )
+    for index, model, condition in sources:
+        query = db.session.query(func.upper(model.symbol), func.count(func.distinct(model.user_id)))
+        if condition is not None:
+            query = query.filter(condition)
+        for symbol, users in query.group_by(func.upper(model.symbol)).all():
+            entry = counts.setdefault(symbol + "USDT", [0, 0, 0])
+            entry[index] = users
+    return {pair: tuple(entry) for pair, entry in counts.items()}
+
+
+def flush_demand(app):
+    with _REQUEST_COUNTS_LOCK:
+        counts = dict(_REQUEST_COUNTS)
+        _REQUEST_COUNTS.clear()
+    record_pair_requests(counts)
+    with app.app_context():
+        memberships = _membership_counts()
+        db.session.remove()
+    set_pair_memberships(memberships)
+
+
+def _flush_loop(app, stop_event):
+    while not stop_event.wait(DEMAND_FLUSH_SEC):
+        try:
+            flush_demand(app)
+        except Exception as e:
+            print(f"Demand flush failed: {e}")
+
+
+_FLUSHER = None
+_FLUSHER_LOCK = threading.Lock()
+
+
+def start_demand_tracking(app):
+    global _FLUSHER
+    with _FLUSHER_LOCK:
+        if _FLUSHER is None:
+            _FLUSHER = threading.Thread(
+                target=_flush_loop,
+                args=(app, threading.Event()),
+                name="demand-flush",
+                daemon=True
+            )
+            _FLUSHER.start()
+    return _FLUSHER
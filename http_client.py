@@ -0,0 +1,247 @@
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE_SEC = float(os.getenv("HTTP_BACKOFF_BASE_SEC", "1.0"))
+HTTP_MAX_BACKOFF_SEC = float(os.getenv("HTTP_MAX_BACKOFF_SEC", "60"))
+# Retries across all hosts draw from one bucket so an outage cannot turn
+# into a retry storm: HTTP_RETRY_BUDGET retries, refilled per second.
+HTTP_RETRY_BUDGET = float(os.getenv("HTTP_RETRY_BUDGET", "30"))
+HTTP_RETRY_BUDGET_PER_SEC = float(os.getenv("HTTP_RETRY_BUDGET_PER_SEC", "0.5"))
+# Optional overrides: "host=rate:burst,host=rate:burst" (rate in tokens/sec).
+HTTP_RATE_LIMITS = os.getenv("HTTP_RATE_LIMITS", "")
+
+DEFAULT_RATE_PER_SEC = 10.0
+DEFAULT_BURST = 20.0
+RETRY_STATUSES = (418, 429, 500, 502, 503, 504)
+RATE_LIMIT_STATUSES = (418, 429)
+
+
+class TokenBucket:
+    """Thread-safe token bucket; reserve() returns how long the caller must wait"""
+
+    def __init__(self, rate, capacity):
+        self.rate = max(float(rate), 0.001)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1.0):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now, 0.0)
+
+    def acquire(self, tokens=1.0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def try_take(self, tokens=1.0):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def pause(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(float(rate), 0.001)
+
+    def on_success(self):
+        pass
+
+    def on_throttle(self):
+        pass
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """Token bucket that halves its rate on a 429 and creeps back up on success (AIMD)"""
+
+    def __init__(self, rate, capacity, min_rate=None, increase_step=None):
+        super().__init__(rate, capacity)
+        self.max_rate = self.rate
+        self.min_rate = min(min_rate or self.rate / 16.0, self.rate)
+        self.increase_step = increase_step or self.max_rate / 20.0
+
+    def on_success(self):
+        if self.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.rate + self.increase_step))
+
+    def on_throttle(self):
+        self.set_rate(max(self.min_rate, self.rate / 2.0))
+
+
+def _host_of(url_or_host):
+    parsed = urlparse(url_or_host if "://" in url_or_host else "//" + url_or_host)
+    return (parsed.netloc or url_or_host).lower()
+
+
+def _parse_rate_overrides(spec):
+    limits = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        host, value = item.split("=", 1)
+        rate, _, burst = value.partition(":")
+        try:
+            limits[_host_of(host.strip())] = (float(rate), float(burst or rate))
+        except ValueError:
+            print(f"Ignoring invalid HTTP_RATE_LIMITS entry: {item}")
+    return limits
+
+
+def parse_retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """Keep-alive session per host with a per-host token bucket and a shared retry budget"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._buckets = {}
+        self._overrides = _parse_rate_overrides(HTTP_RATE_LIMITS)
+        self._lock = threading.Lock()
+        self.retry_budget = TokenBucket(HTTP_RETRY_BUDGET_PER_SEC, HTTP_RETRY_BUDGET)
+        self._stats = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0, "bytes": 0}
+        self._stats_lock = threading.Lock()
+
+    def record(self, requests=0, retries=0, throttled=0, errors=0, nbytes=0):
+        """Add to the process-wide request counters (also fed by async_ingest)"""
+        with self._stats_lock:
+            self._stats["requests"] += requests
+            self._stats["retries"] += retries
+            self._stats["throttled"] += throttled
+            self._stats["errors"] += errors
+            self._stats["bytes"] += nbytes
+
+    def stats_snapshot(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def configure_host(self, url_or_host, rate, burst=None, adaptive=False):
+        host = _host_of(url_or_host)
+        rate, burst = self._overrides.get(host, (rate, burst or rate))
+        bucket_cls = AdaptiveTokenBucket if adaptive else TokenBucket
+        with self._lock:
+            self._buckets[host] = bucket_cls(rate, burst)
+
+    def bucket_for(self, url_or_host):
+        host = _host_of(url_or_host)
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate, burst = self._overrides.get(host, (DEFAULT_RATE_PER_SEC, DEFAULT_BURST))
+                bucket = self._buckets[host] = TokenBucket(rate, burst)
+            return bucket
+
+    def session_for(self, url_or_host):
+        host = _host_of(url_or_host)
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def get(self, url, params=None, headers=None, timeout=10, cost=1.0,
+            max_retries=HTTP_MAX_RETRIES, backoff_base=HTTP_BACKOFF_BASE_SEC):
+        """GET through the host's pool and limiter; returns the last response or raises"""
+        bucket = self.bucket_for(url)
+        session = self.session_for(url)
+
+        for attempt in range(max_retries + 1):
+            bucket.acquire(cost)
+            backoff = min(backoff_base * (2 ** attempt), HTTP_MAX_BACKOFF_SEC)
+            can_retry = attempt < max_retries
+            retries = 1 if attempt else 0
+
+            try:
+                r = session.get(url, params=params, headers=headers, timeout=timeout)
+            except requests.RequestException:
+                self.record(requests=1, retries=retries, errors=1)
+                if not can_retry or not self.retry_budget.try_take():
+                    raise
+                time.sleep(backoff)
+                continue
+
+            throttled = r.status_code in RATE_LIMIT_STATUSES
+            self.record(
+                requests=1,
+                retries=retries,
+                throttled=1 if throttled else 0,
+                errors=1 if r.status_code >= 400 else 0,
+                nbytes=len(r.content)
+            )
+            if throttled:
+                bucket.on_throttle()
+            elif r.status_code < 400:
+                bucket.on_success()
+
+            if r.status_code not in RETRY_STATUSES or not can_retry:
+                return r
+            if not self.retry_budget.try_take():
+                print(f"HTTP retry budget exhausted; giving up on {urlparse(url).netloc} ({r.status_code})")
+                return r
+
+            wait = min(parse_retry_after(r) or backoff, HTTP_MAX_BACKOFF_SEC)
+            if r.status_code in RATE_LIMIT_STATUSES:
+                # Hold back every caller on this host, not just this thread.
+                print(f"Rate limit hit on {urlparse(url).netloc}; waiting {wait:.1f}s before retry")
+                bucket.pause(wait)
+            else:
+                time.sleep(wait)
+
+        return r
+
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_http_client():
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = HttpClient()
+    return _CLIENT
+
+
+def http_get(url, **kwargs):
+    return get_http_client().get(url, **kwargs)
@@ -3,8 +3,8 @@ import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics import mean_squared_error, mean_absolute_percentage_error, r2_score
 from sqlalchemy import text
-from crypto import ensure_ohlcv_data, get_db_engine, fetch_mapping
-from datetime import datetime, timedelta
+from crypto import ensure_ohlcv_data, get_db_engine, get_read_engine, fetch_mapping, ohlcv_cutoff_day
+from datetime import timedelta
 import pickle
 import os
 
@@ -38,21 +38,22 @@ class LSTMPricePredictor:
     def get_historical_data(self, days=365):
         """Fetch historical OHLCV data from database"""
         pair = self.symbol + 'USDT'
-        cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        cutoff_day = ohlcv_cutoff_day(days)
 
         query = """
             SELECT date, open, high, low, close, volume
             FROM ohlcv_data
-            WHERE symbol = :symbol AND date >= :cutoff_date
-            ORDER BY date ASC
+            WHERE symbol = :symbol AND day >= :cutoff_day
+            ORDER BY day ASC
         """
 
-        engine = get_db_engine()
-        df = pd.read_sql_query(text(query), engine, params={"symbol": pair, "cutoff_date": cutoff_date})
+        params = {"symbol": pair, "cutoff_day": cutoff_day}
+        df = pd.read_sql_query(text(query), get_read_engine(), params=params)
 
         if df.empty:
-            ensure_ohlcv_data(self.symbol)
-            df = pd.read_sql_query(text(query), engine, params={"symbol": pair, "cutoff_date": cutoff_date})
+            ensure_ohlcv_data(self.symbol, max_days=days)
+            # Just written to the primary; a replica may not have it yet.
+            df = pd.read_sql_query(text(query), get_db_engine(), params=params)
             if df.empty:
                 return None
 
@@ -298,7 +299,7 @@ def predict_price(symbol, days_ahead=7, lookback_days=30):
 
         # Get current price
         coin = fetch_mapping(
-            "SELECT price FROM top_coins WHERE UPPER(symbol) = :symbol",
+            "SELECT price FROM top_coins WHERE symbol_key = :symbol",
             {"symbol": symbol.upper()}
         )
         current_price = coin['price'] if coin else None
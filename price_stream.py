@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import crypto
+
+try:
+    import websockets
+    WEBSOCKETS_AVAILABLE = True
+except ImportError:
+    WEBSOCKETS_AVAILABLE = False
+
+# Combined-stream URL; point it at a local server to replay recorded ticks.
+# Unset, it follows the Binance REST base crypto.py settled on (binance.us
+# where binance.com answers 451).
+PRICE_STREAM_URL = os.getenv("PRICE_STREAM_URL", "").strip()
+BINANCE_STREAM_HOSTS = {
+    "https://api.binance.com": "wss://stream.binance.com:9443",
+    "https://api.binance.us": "wss://stream.binance.us:9443"
+}
+BINANCE_STREAM_PATH = "/stream?streams=!miniTicker@arr"
+PRICE_STREAM_ENABLED = os.getenv("PRICE_STREAM_ENABLED", "1") != "0"
+# Changed prices are written to top_coins at most this often (across workers).
+PRICE_STREAM_FLUSH_SEC = float(os.getenv("PRICE_STREAM_FLUSH_SEC", "10"))
+# Ticks older than this are ignored, e.g. while the stream is reconnecting.
+PRICE_STREAM_MAX_AGE_SEC = float(os.getenv("PRICE_STREAM_MAX_AGE_SEC", "120"))
+PRICE_STREAM_MAX_BACKOFF_SEC = float(os.getenv("PRICE_STREAM_MAX_BACKOFF_SEC", "60"))
+# Static coin fields (name, rank, market cap) are re-read from top_coins this often.
+COIN_CACHE_TTL_SEC = float(os.getenv("COIN_CACHE_TTL_SEC", "60"))
+
+
+class LastPriceTable:
+    """Thread-safe SYMBOL -> (price, quote volume, received_at) map fed by the stream"""
+
+    def __init__(self):
+        self._prices = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def update(self, ticks, received_at=None):
+        received_at = received_at or time.time()
+        with self._lock:
+            for symbol, price, volume in ticks:
+                self._prices[symbol] = (price, volume, received_at)
+                self._dirty.add(symbol)
+
+    def get(self, symbol, max_age=PRICE_STREAM_MAX_AGE_SEC):
+        entry = self._prices.get(symbol.upper())
+        if entry is None or time.time() - entry[2] > max_age:
+            return None
+        return entry
+
+    def take_dirty(self):
+        """Prices changed since the previous call, as {SYMBOL: (price, volume)}"""
+        with self._lock:
+            changed = {s: self._prices[s][:2] for s in self._dirty}
+            self._dirty.clear()
+        return changed
+
+    def __len__(self):
+        return len(self._prices)
+
+
+class CoinCache:
+    """Whole top_coins table kept in memory and reloaded every COIN_CACHE_TTL_SEC"""
+
+    def __init__(self, ttl_sec=COIN_CACHE_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._coins = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        rows = crypto.fetch_mappings(
+            f"SELECT {', '.join(crypto.TOP_COINS_COLUMNS)} FROM top_coins ORDER BY market_cap_rank DESC"
+        )
+        # Several coins can share a ticker; ascending rank wins the last write.
+        self._coins = {row["symbol"].upper(): row for row in rows if row.get("symbol")}
+        self._loaded_at = time.time()
+
+    def get(self, symbol):
+        if time.time() - self._loaded_at > self.ttl_sec:
+            with self._lock:
+                if time.time() - self._loaded_at > self.ttl_sec:
+                    self._reload()
+        return self._coins.get(symbol.upper())
+
+
+LAST_PRICES = LastPriceTable()
+COINS = CoinCache()
+
+
+def get_live_price(symbol):
+    """Latest streamed price, falling back to the cached top_coins price"""
+    entry = LAST_PRICES.get(symbol)
+    if entry is not None:
+        return entry[0]
+    coin = COINS.get(symbol)
+    return coin["price"] if coin else None
+
+
+def get_coin(symbol):
+    """top_coins row for symbol with the streamed price and volume applied"""
+    coin = COINS.get(symbol)
+    if coin is None:
+        return None
+    entry = LAST_PRICES.get(symbol)
+    if entry is None:
+        return coin
+    return {**coin, "price": entry[0], "volume_24h": entry[1]}
+
+
+def parse_ticker_message(message):
+    """Ticks as [(SYMBOL, price, quote volume)] from a raw or combined-stream miniTicker payload"""
+    payload = json.loads(message)
+    if isinstance(payload, dict) and "data" in payload:
+        payload = payload["data"]
+    if isinstance(payload, dict):
+        payload = [payload]
+
+    ticks = []
+    for t in payload:
+        pair = t.get("s", "")
+        if not pair.endswith("USDT") or len(pair) <= 4:
+            continue
+        try:
+            ticks.append((pair[:-4], float(t["c"]), float(t.get("q") or 0)))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return ticks
+
+
+def binance_stream_url():
+    """Combined-stream URL on the websocket host of the active Binance REST base, or None if it has none"""
+    # Loads (or fetches) the symbol set, which also settles the active base
+    # past bases that answer 451.
+    crypto.get_binance_symbols()
+    host = BINANCE_STREAM_HOSTS.get(crypto._ACTIVE_BINANCE_BASE)
+    return host + BINANCE_STREAM_PATH if host else None
+
+
+class PriceStreamIngester(threading.Thread):
+    """Keeps LAST_PRICES current from the ticker stream and flushes it to top_coins"""
+
+    def __init__(self, url=PRICE_STREAM_URL, flush_sec=PRICE_STREAM_FLUSH_SEC, table=LAST_PRICES):
+        super().__init__(name="price-stream", daemon=True)
+        self.url = url
+        self.flush_sec = flush_sec
+        self.table = table
+        self.messages = 0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            try:
+                # Re-resolved on every reconnect so a switch of Binance base is followed.
+                url = self.url or await loop.run_in_executor(None, binance_stream_url)
+                if url is None:
+                    print(f"No price stream for Binance base {crypto._ACTIVE_BINANCE_BASE}; set PRICE_STREAM_URL")
+                    return
+                async with websockets.connect(url, ping_interval=20, max_size=2 ** 23) as ws:
+                    print(f"Price stream connected: {url}")
+                    backoff = 1.0
+                    async for message in ws:
+                        self.table.update(parse_ticker_message(message))
+                        self.messages += 1
+                        if self._stop_event.is_set():
+                            return
+            except Exception as e:
+                print(f"Price stream disconnected ({e}); reconnecting in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, PRICE_STREAM_MAX_BACKOFF_SEC)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while not self._stop_event.is_set():
+            await asyncio.sleep(self.flush_sec)
+            changed = self.table.take_dirty()
+            if not changed:
+                continue
+            try:
+                # Every worker sees the same ticks, so whichever flushes first
+                # covers the others for this interval.
+                await loop.run_in_executor(
+                    None, crypto.refresh_top_coin_prices, self.flush_sec, changed
+                )
+            except Exception as e:
+                print(f"Price stream flush failed: {e}")
+
+    async def _main(self):
+        flusher = asyncio.create_task(self._flush_loop())
+        try:
+            await self._consume()
+        finally:
+            flusher.cancel()
+
+    def run(self):
+        asyncio.run(self._main())
+
+
+_INGESTER = None
+_INGESTER_LOCK = threading.Lock()
+
+
+def start_price_stream():
+    global _INGESTER
+    if not PRICE_STREAM_ENABLED:
+        return None
+    if not WEBSOCKETS_AVAILABLE:
+        print("websockets not installed; live price stream disabled")
+        return None
+    with _INGESTER_LOCK:
+        if _INGESTER is None:
+            _INGESTER = PriceStreamIngester()
+            _INGESTER.start()
+    return _INGESTER
+
+
+if __name__ == "__main__":
+    crypto.check_schema()
+    ingester = start_price_stream()
+    if ingester is None:
+        raise SystemExit("Price stream disabled")
+    try:
+        while ingester.is_alive():
+            ingester.join(timeout=1.0)
+    except KeyboardInterrupt:
+        ingester.stop()
@@ -0,0 +1,310 @@
+import datetime as dt
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+
+import crypto
+from crypto import check_schema, execute_write, fetch_mapping, fetch_mappings, get_db_engine, read_your_writes
+from sqlalchemy import text
+
+# Cron-style schedule in UTC: "minute hour day-of-month month day-of-week".
+# Empty disables scheduled runs; /api/update-data can still enqueue one.
+PIPELINE_SCHEDULE = os.getenv("PIPELINE_SCHEDULE", "0 3 * * *").strip()
+SCHEDULER_POLL_SEC = float(os.getenv("SCHEDULER_POLL_SEC", "15"))
+SCHEDULER_JOB_TIMEOUT_SEC = int(os.getenv("SCHEDULER_JOB_TIMEOUT_SEC", "10800"))
+# "embedded" starts the scheduler thread inside each web process (jobs are
+# claimed atomically, so only one runs); "external" leaves it to
+# `python scheduler.py`; "off" disables it.
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "embedded").strip().lower()
+# Interval for topping up stale hot pairs between full runs (0 disables).
+OHLCV_HOT_REFRESH_SEC = float(os.getenv("OHLCV_HOT_REFRESH_SEC", "900"))
+# top_coins price/volume refresh interval (0 disables).
+PRICE_REFRESH_SEC = crypto.PRICE_REFRESH_SEC
+
+
+# ==================== CRON ====================
+
+def _parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(v) for v in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field out of range: {field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(expr):
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"Cron expression needs 5 fields: {expr!r}")
+    minute, hour, dom, month, dow = fields
+    return {
+        "minute": _parse_cron_field(minute, 0, 59),
+        "hour": _parse_cron_field(hour, 0, 23),
+        "dom": _parse_cron_field(dom, 1, 31),
+        "month": _parse_cron_field(month, 1, 12),
+        # 0 and 7 are both Sunday
+        "dow": {d % 7 for d in _parse_cron_field(dow, 0, 7)},
+        "dom_any": dom == "*",
+        "dow_any": dow == "*"
+    }
+
+
+def cron_matches(cron, when):
+    if when.minute not in cron["minute"] or when.hour not in cron["hour"]:
+        return False
+    if when.month not in cron["month"]:
+        return False
+    dom_ok = when.day in cron["dom"]
+    dow_ok = (when.isoweekday() % 7) in cron["dow"]
+    # Standard cron: when both day fields are restricted, either may match.
+    if cron["dom_any"] or cron["dow_any"]:
+        return dom_ok and dow_ok
+    return dom_ok or dow_ok
+
+
+# ==================== JOBS ====================
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _job_to_dict(row):
+    if not row:
+        return None
+    job = dict(row)
+    if job.get("stats"):
+        try:
+            job["stats"] = json.loads(job["stats"])
+        except ValueError:
+            pass
+    return job
+
+
+def get_job(job_id):
+    return _job_to_dict(fetch_mapping("SELECT * FROM pipeline_jobs WHERE id = :id", {"id": job_id}))
+
+
+def get_active_job():
+    return _job_to_dict(fetch_mapping(
+        "SELECT * FROM pipeline_jobs WHERE status IN ('queued', 'running') ORDER BY requested_at ASC LIMIT 1"
+    ))
+
+
+def list_jobs(limit=20):
+    rows = fetch_mappings(
+        "SELECT * FROM pipeline_jobs ORDER BY requested_at DESC LIMIT :limit",
+        {"limit": limit}
+    )
+    return [_job_to_dict(row) for row in rows]
+
+
+def enqueue_pipeline_run(source="manual", job_id=None):
+    """Queue a pipeline run unless one is already queued or running; returns (job, created)"""
+    with read_your_writes():
+        active = get_active_job()
+        if active:
+            return active, False
+
+        job_id = job_id or uuid.uuid4().hex
+        engine = get_db_engine()
+        with engine.begin() as conn:
+            created = conn.execute(text("""
+                INSERT INTO pipeline_jobs (id, status, source, requested_at)
+                VALUES (:id, 'queued', :source, :requested_at)
+                ON CONFLICT (id) DO NOTHING
+            """), {"id": job_id, "source": source, "requested_at": _now_ms()}).rowcount
+        return get_job(job_id), bool(created)
+
+
+def _claim_next_job(worker):
+    job = fetch_mapping(
+        "SELECT id FROM pipeline_jobs WHERE status = 'queued' ORDER BY requested_at ASC LIMIT 1"
+    )
+    if not job:
+        return None
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        claimed = conn.execute(text("""
+            UPDATE pipeline_jobs
+            SET status = 'running', started_at = :started_at, worker = :worker
+            WHERE id = :id AND status = 'queued'
+        """), {"id": job["id"], "started_at": _now_ms(), "worker": worker}).rowcount
+    return job["id"] if claimed else None
+
+
+def _finish_job(job_id, status, stats=None, error=None):
+    execute_write("""
+        UPDATE pipeline_jobs
+        SET status = :status, finished_at = :finished_at, stats = :stats, error = :error
+        WHERE id = :id AND status = 'running'
+    """, {
+        "id": job_id,
+        "status": status,
+        "finished_at": _now_ms(),
+        "stats": json.dumps(stats) if stats is not None else None,
+        "error": error
+    })
+
+
+def _expire_stale_jobs():
+    cutoff = _now_ms() - SCHEDULER_JOB_TIMEOUT_SEC * 1000
+    execute_write("""
+        UPDATE pipeline_jobs
+        SET status = 'failed', finished_at = :now, error = 'Job exceeded SCHEDULER_JOB_TIMEOUT_SEC'
+        WHERE status = 'running' AND started_at < :cutoff
+    """, {"now": _now_ms(), "cutoff": cutoff})
+
+
+def _run_job_process(job_id):
+    """Entry point of the child process that executes one pipeline run"""
+    from crypto import run_pipeline
+
+    try:
+        stats = run_pipeline(job_id=job_id)
+    except Exception as e:
+        print(f"Pipeline job {job_id} failed: {e}")
+        _finish_job(job_id, "failed", error=str(e)[:1000])
+        raise
+    if stats.get("skipped"):
+        status, error = "failed", stats.get("reason")
+    elif stats.get("top_coins", 0):
+        status, error = "succeeded", None
+    else:
+        status, error = "failed", "Top coins table is still empty after update"
+    if status == "succeeded":
+        from snapshots import export_snapshots_after_run
+        stats["snapshots"] = export_snapshots_after_run()
+    _finish_job(job_id, status, stats=stats, error=error)
+
+
+# ==================== SCHEDULER LOOP ====================
+
+class PipelineScheduler(threading.Thread):
+    """Enqueues runs on PIPELINE_SCHEDULE and executes queued jobs in a child process"""
+
+    def __init__(self, schedule=PIPELINE_SCHEDULE, poll_sec=SCHEDULER_POLL_SEC):
+        super().__init__(name="pipeline-scheduler", daemon=True)
+        self.cron = parse_cron(schedule) if schedule else None
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.process = None
+        self.job_id = None
+        # Light periodic tasks run on their own threads; name -> [interval, next run, thread]
+        self.periodic = {
+            name: [interval, time.time() + interval, None]
+            for name, interval in (("hot-refresh", OHLCV_HOT_REFRESH_SEC), ("price-refresh", PRICE_REFRESH_SEC))
+            if interval
+        }
+        intervals = [interval for interval, _, _ in self.periodic.values()]
+        self.wait_sec = min([poll_sec] + intervals)
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _enqueue_if_due(self):
+        if not self.cron:
+            return
+        now = dt.datetime.now(dt.timezone.utc)
+        if cron_matches(self.cron, now):
+            # One job id per scheduled minute, so several schedulers firing
+            # in the same minute enqueue a single run.
+            enqueue_pipeline_run("schedule", job_id="schedule-" + now.strftime("%Y%m%d%H%M"))
+
+    def _reap(self):
+        if self.process is None or self.process.is_alive():
+            return
+        if self.process.exitcode != 0:
+            _finish_job(self.job_id, "failed", error=f"Pipeline process exited with code {self.process.exitcode}")
+        self.process = None
+        self.job_id = None
+
+    def _start_next(self):
+        if self.process is not None:
+            return
+        job_id = _claim_next_job(self.worker)
+        if not job_id:
+            return
+        print(f"Starting pipeline job {job_id}")
+        ctx = multiprocessing.get_context("spawn")
+        self.process = ctx.Process(target=_run_job_process, args=(job_id,), name=f"pipeline-{job_id}")
+        self.process.start()
+        self.job_id = job_id
+
+    def _run_periodic(self, name):
+        try:
+            if name == "hot-refresh":
+                crypto.refresh_hot_pairs()
+            elif name == "price-refresh":
+                crypto.refresh_top_coin_prices()
+        except Exception as e:
+            print(f"Periodic task {name} failed: {e}")
+
+    def _start_periodic(self):
+        now = time.time()
+        for name, task in self.periodic.items():
+            interval, next_run, thread = task
+            if now < next_run or (thread and thread.is_alive()):
+                continue
+            # Hot pairs are covered by a running pipeline; prices are not.
+            if name == "hot-refresh" and self.process is not None:
+                continue
+            task[1] = now + interval
+            task[2] = threading.Thread(target=self._run_periodic, args=(name,), name=name, daemon=True)
+            task[2].start()
+
+    def tick(self):
+        self._reap()
+        _expire_stale_jobs()
+        self._enqueue_if_due()
+        self._start_next()
+        self._start_periodic()
+
+    def run(self):
+        # Job claiming reads what other schedulers just wrote.
+        with read_your_writes():
+            while not self._stop_event.is_set():
+                try:
+                    self.tick()
+                except Exception as e:
+                    print(f"Scheduler tick failed: {e}")
+                self._stop_event.wait(self.wait_sec)
+
+
+_SCHEDULER = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def start_scheduler():
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = PipelineScheduler()
+            _SCHEDULER.start()
+    return _SCHEDULER
+
+
+if __name__ == "__main__":
+    check_schema()
+    scheduler = start_scheduler()
+    print(f"Pipeline scheduler running (schedule={PIPELINE_SCHEDULE or 'off'})")
+    try:
+        while scheduler.is_alive():
+            scheduler.join(timeout=1.0)
+    except KeyboardInterrupt:
+        scheduler.stop()
@@ -0,0 +1,219 @@
+import json
+import os
+import time
+
+import pandas as pd
+from sqlalchemy import text
+
+import crypto
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Columnar copies of ohlcv_data for bulk consumers, refreshed after each
+# pipeline run: one file per pair plus one combined file with a row group
+# per pair, described by manifest.json.
+OHLCV_SNAPSHOTS_ENABLED = os.getenv("OHLCV_SNAPSHOTS", "1") != "0"
+OHLCV_SNAPSHOT_DIR = os.getenv("OHLCV_SNAPSHOT_DIR", os.path.join(crypto.DATA_DIR, "snapshots", "ohlcv"))
+# "parquet" or "arrow" (Arrow IPC file); both zstd-compressed.
+OHLCV_SNAPSHOT_FORMAT = os.getenv("OHLCV_SNAPSHOT_FORMAT", "parquet").strip().lower()
+OHLCV_SNAPSHOT_COMPRESSION = os.getenv("OHLCV_SNAPSHOT_COMPRESSION", "zstd")
+
+MANIFEST_NAME = "manifest.json"
+COMBINED_STEM = "ohlcv_all"
+SNAPSHOT_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+SNAPSHOT_MIMETYPES = {".parquet": "application/vnd.apache.parquet", ".arrow": "application/vnd.apache.arrow.file"}
+
+_PAIR_QUERY = """
+    SELECT symbol, timestamp, date, open, high, low, close, volume
+    FROM ohlcv_data
+    WHERE symbol = :symbol
+    ORDER BY timestamp ASC
+"""
+
+
+def _schema():
+    return pa.schema([
+        ("symbol", pa.string()),
+        ("timestamp", pa.int64()),
+        ("date", pa.string()),
+        ("open", pa.float64()),
+        ("high", pa.float64()),
+        ("low", pa.float64()),
+        ("close", pa.float64()),
+        ("volume", pa.float64())
+    ])
+
+
+def _extension():
+    if OHLCV_SNAPSHOT_FORMAT not in SNAPSHOT_EXTENSIONS:
+        raise ValueError(f"OHLCV_SNAPSHOT_FORMAT must be 'parquet' or 'arrow', got {OHLCV_SNAPSHOT_FORMAT!r}")
+    return SNAPSHOT_EXTENSIONS[OHLCV_SNAPSHOT_FORMAT]
+
+
+class _SnapshotWriter:
+    """Writes tables to a temp file in the configured format and moves it into place on close"""
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        if OHLCV_SNAPSHOT_FORMAT == "arrow":
+            self._sink = pa.OSFile(self.tmp_path, "wb")
+            options = pa.ipc.IpcWriteOptions(compression=OHLCV_SNAPSHOT_COMPRESSION)
+            self._writer = pa.ipc.new_file(self._sink, schema, options=options)
+        else:
+            self._sink = None
+            self._writer = pq.ParquetWriter(self.tmp_path, schema, compression=OHLCV_SNAPSHOT_COMPRESSION)
+
+    def write(self, table):
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        os.replace(self.tmp_path, self.path)
+        return os.path.getsize(self.path)
+
+
+def _read_snapshot(path):
+    if path.endswith(".arrow"):
+        return pa.ipc.open_file(path).read_all()
+    return pq.read_table(path)
+
+
+def load_snapshot_manifest():
+    path = os.path.join(OHLCV_SNAPSHOT_DIR, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _save_manifest(manifest):
+    path = os.path.join(OHLCV_SNAPSHOT_DIR, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def _pair_is_current(entry, state, extension):
+    # ingestion_state moves whenever candles are added or expired, so an
+    # unchanged watermark means the file still matches the table.
+    return (
+        entry is not None
+        and entry["file"].endswith(extension)
+        and entry["source_rows"] == state["row_count"]
+        and entry["first_ts"] == state["first_ts"]
+        and entry["last_ts"] == state["last_ts"]
+        and os.path.exists(os.path.join(OHLCV_SNAPSHOT_DIR, entry["file"]))
+    )
+
+
+def export_ohlcv_snapshots(force=False):
+    """Rewrite the snapshot of every pair whose candles changed since the last export; returns stats"""
+    extension = _extension()
+    os.makedirs(OHLCV_SNAPSHOT_DIR, exist_ok=True)
+    started = time.perf_counter()
+    schema = _schema()
+
+    previous = (load_snapshot_manifest() or {}).get("pairs", {})
+    states = {
+        pair: state for pair, state in crypto.load_ingestion_states().items()
+        if state.get("row_count") and state.get("last_ts") is not None
+    }
+    stats = {"pairs_written": 0, "pairs_unchanged": 0, "pairs_removed": 0, "rows_written": 0}
+    pairs = {}
+
+    # Straight from the primary: the manifest records the watermark the
+    # file was cut at, which a lagging replica would get wrong.
+    engine = crypto.get_db_engine()
+    with engine.connect() as conn:
+        for pair in sorted(states):
+            state = states[pair]
+            entry = previous.get(pair)
+            if not force and _pair_is_current(entry, state, extension):
+                pairs[pair] = entry
+                stats["pairs_unchanged"] += 1
+                continue
+
+            df = pd.read_sql_query(text(_PAIR_QUERY), conn, params={"symbol": pair})
+            if df.empty:
+                continue
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            writer = _SnapshotWriter(os.path.join(OHLCV_SNAPSHOT_DIR, pair + extension), schema)
+            writer.write(table)
+            size = writer.close()
+            pairs[pair] = {
+                "file": pair + extension,
+                "rows": table.num_rows,
+                "bytes": size,
+                "first_date": df["date"].iloc[0],
+                "last_date": df["date"].iloc[-1],
+                "first_ts": state["first_ts"],
+                "last_ts": state["last_ts"],
+                "source_rows": state["row_count"]
+            }
+            stats["pairs_written"] += 1
+            stats["rows_written"] += table.num_rows
+
+    for pair, entry in previous.items():
+        if pair in pairs:
+            continue
+        stats["pairs_removed"] += 1
+        path = os.path.join(OHLCV_SNAPSHOT_DIR, entry["file"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    combined = os.path.join(OHLCV_SNAPSHOT_DIR, COMBINED_STEM + extension)
+    if stats["pairs_written"] or stats["pairs_removed"] or not os.path.exists(combined) or force:
+        # Built from the per-pair files one row group at a time, so memory
+        # stays at one pair regardless of how many there are.
+        writer = _SnapshotWriter(combined, schema)
+        for pair in sorted(pairs):
+            writer.write(_read_snapshot(os.path.join(OHLCV_SNAPSHOT_DIR, pairs[pair]["file"])))
+        combined_bytes = writer.close()
+    else:
+        combined_bytes = os.path.getsize(combined)
+
+    _save_manifest({
+        "format": OHLCV_SNAPSHOT_FORMAT,
+        "compression": OHLCV_SNAPSHOT_COMPRESSION,
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "combined": {
+            "file": COMBINED_STEM + extension,
+            "rows": sum(entry["rows"] for entry in pairs.values()),
+            "bytes": combined_bytes
+        },
+        "pairs": pairs
+    })
+    stats["pairs"] = len(pairs)
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    print(f"OHLCV snapshots: {stats}")
+    return stats
+
+
+def export_snapshots_after_run():
+    """Hook for the pipeline job: export when enabled, never failing the run"""
+    if not OHLCV_SNAPSHOTS_ENABLED:
+        return None
+    if not PYARROW_AVAILABLE:
+        print("pyarrow not installed; OHLCV snapshots disabled")
+        return None
+    try:
+        return export_ohlcv_snapshots()
+    except Exception as e:
+        print(f"OHLCV snapshot export failed: {e}")
+        return {"error": str(e)[:500]}
+
+
+if __name__ == "__main__":
+    if not PYARROW_AVAILABLE:
+        raise SystemExit("pyarrow is required for OHLCV snapshots")
+    crypto.check_schema()
+    export_ohlcv_snapshots(force=True)
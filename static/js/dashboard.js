@@ -216,23 +216,47 @@ function updateData() {
     btn.disabled = true;
     btn.innerHTML = '<span class="spinner-border spinner-border-sm"></span> Updating...';
 
+    const resetButton = () => {
+        btn.disabled = false;
+        btn.innerHTML = '<i class="bi bi-arrow-repeat"></i> Update Data';
+    };
+
     fetch('/api/update-data', { method: 'POST' })
         .then(response => response.json())
         .then(data => {
-            if (data.success) {
-                showSuccess('Data updated successfully');
-                loadCoins();
+            if (data.success && data.job_id) {
+                pollUpdateJob(data.job_id, resetButton);
             } else {
                 showError(data.error || 'Failed to update data');
+                resetButton();
             }
         })
         .catch(error => {
             console.error('Error:', error);
             showError('Failed to update data');
+            resetButton();
+        });
+}
+
+function pollUpdateJob(jobId, onDone) {
+    fetch(`/api/update-data/${jobId}`)
+        .then(response => response.json())
+        .then(job => {
+            if (job.status === 'succeeded') {
+                showSuccess('Data updated successfully');
+                loadCoins();
+                onDone();
+            } else if (job.status === 'failed' || job.error) {
+                showError(job.error || 'Failed to update data');
+                onDone();
+            } else {
+                setTimeout(() => pollUpdateJob(jobId, onDone), 5000);
+            }
         })
-        .finally(() => {
-            btn.disabled = false;
-            btn.innerHTML = '<i class="bi bi-arrow-repeat"></i> Update Data';
+        .catch(error => {
+            console.error('Error:', error);
+            showError('Failed to check update status');
+            onDone();
         });
 }
 
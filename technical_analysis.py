@@ -2,28 +2,29 @@ import pandas as pd
 import numpy as np
 from ta import momentum, trend, volatility, volume
 from sqlalchemy import text
-from crypto import ensure_ohlcv_data, get_db_engine, fetch_mapping
-from datetime import datetime, timedelta
+from crypto import ensure_ohlcv_data, get_db_engine, get_read_engine, fetch_mapping, ohlcv_cutoff_day
+from datetime import datetime
 
 
 def get_ohlcv_data(symbol, days=365):
     """Fetch OHLCV data from database for given symbol"""
     pair = symbol.upper() + 'USDT'
-    cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    cutoff_day = ohlcv_cutoff_day(days)
 
     query = """
         SELECT date, open, high, low, close, volume
         FROM ohlcv_data
-        WHERE symbol = :symbol AND date >= :cutoff_date
-        ORDER BY date ASC
+        WHERE symbol = :symbol AND day >= :cutoff_day
+        ORDER BY day ASC
     """
 
-    engine = get_db_engine()
-    df = pd.read_sql_query(text(query), engine, params={"symbol": pair, "cutoff_date": cutoff_date})
+    params = {"symbol": pair, "cutoff_day": cutoff_day}
+    df = pd.read_sql_query(text(query), get_read_engine(), params=params)
 
     if df.empty:
-        ensure_ohlcv_data(symbol)
-        df = pd.read_sql_query(text(query), engine, params={"symbol": pair, "cutoff_date": cutoff_date})
+        ensure_ohlcv_data(symbol, max_days=days)
+        # Just written to the primary; a replica may not have it yet.
+        df = pd.read_sql_query(text(query), get_db_engine(), params=params)
         if df.empty:
             return None
 
@@ -375,7 +376,7 @@ def analyze_symbol(symbol, timeframe='1y'):
 
     # Get current price
     coin = fetch_mapping(
-        "SELECT price, market_cap, volume_24h FROM top_coins WHERE UPPER(symbol) = :symbol",
+        "SELECT price, market_cap, volume_24h FROM top_coins WHERE symbol_key = :symbol",
         {"symbol": symbol.upper()}
     )
 